@@ -18,12 +18,29 @@ def create_app(test_config: dict = None) -> Flask:
     app.config.from_mapping(
         STORE_PATH=app.instance_path + "/public/store",
         JSON_PATH=app.instance_path + "/public/json",
+        API_PATH=app.instance_path + "/public/api",
         CACHE_PATH=app.instance_path + "/cache/",
         REDIS_CONN=Redis(),
         TESTING=False,
         DEBUG=False,
         UPSTREAM_URL="https://downloads.cdn.openwrt.org",
+        UPSTREAM_TTL=300,
         VERSIONS={},
+        INDEX_CHECK_INTERVAL=10,
+        LONG_POLL_TIMEOUT=30,
+        BATCH_SIZE_MAX=500,
+        JOB_TIMEOUT="5m",
+        QUEUE_LENGTH_MAX=100,
+        QUEUE_LENGTH_MAX_TOTAL=1000,
+        TARGET_QUEUE_LENGTH_MAX={},
+        BUILD_DURATION_DEFAULT=60,
+        BODY_CACHE_SIZE=1000,
+        RESOLVE_MANIFEST=False,
+        STAGE_BUILD=False,
+        PACKAGE_CACHE_SIZE=10 * 1024**3,
+        PACKAGE_PREFETCH=100,
+        JANITOR_WORKERS=16,
+        JANITOR_HOST_CONNECTIONS=8,
     )
 
     if test_config is None:
@@ -63,4 +80,8 @@ def create_app(test_config: dict = None) -> Flask:
 
     app.register_blueprint(api.bp)
 
+    from . import metrics
+
+    app.register_blueprint(metrics.bp)
+
     return app
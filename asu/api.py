@@ -1,9 +1,24 @@
-from uuid import uuid4
-from flask import request, g, current_app, Blueprint
+from collections import OrderedDict
+from math import ceil
+import sys
+from time import monotonic
+
+from flask import (
+    request,
+    g,
+    current_app,
+    Blueprint,
+    json,
+    Response,
+    stream_with_context,
+)
 from rq import Connection, Queue
+from rq.job import Job
+from rq.utils import parse_timeout
 
-from .build import build
-from .common import get_request_hash
+from .build import build, load_result
+from .common import get_canonical_request, get_request_hash, get_str_hash
+from .worker import get_channel
 
 bp = Blueprint("api", __name__, url_prefix="/api")
 
@@ -52,16 +67,120 @@ def get_redis():
     return g.redis
 
 
-def get_queue() -> Queue:
-    """Return the current queue
+def get_queue(name: str = "default") -> Queue:
+    """Return a queue
+
+    Build jobs are enqueued per target, allowing workers to prefer targets
+    with an ImageBuilder already set up.
+
+    Args:
+        name (str): Queue name, usually the target
 
     Returns:
-        Queue: The current RQ work queue
+        Queue: The RQ work queue
     """
-    if "queue" not in g:
+    if "queues" not in g:
+        g.queues = {}
+    if name not in g.queues:
         with Connection():
-            g.queue = Queue(connection=get_redis())
-    return g.queue
+            g.queues[name] = Queue(name, connection=get_redis())
+    return g.queues[name]
+
+
+def fetch_job(request_hash: str) -> Job:
+    """Return the job of a request independent of its queue
+
+    Args:
+        request_hash (str): Request hash to lookup
+
+    Returns:
+        Job: The build job or None if not found
+    """
+    return Job.fetch_many([request_hash], connection=get_redis())[0]
+
+
+def load_index(branch: str) -> dict:
+    """Load the validation index of a branch from Redis
+
+    All data written by the janitor is fetched within two transactions. If the
+    janitor stored a new generation in between, the index is loaded again.
+    The packages of each target are stored as frozenset to allow fast set
+    arithmetic during validation. Package names are interned, so names shared
+    by multiple targets and branches are kept in memory once.
+
+    Args:
+        branch (str): Branch name as defined in VERSIONS
+
+    Returns:
+        dict: Index containing `generation`, `mapping`, `profiles` and
+              `packages` of the branch
+    """
+    r = get_redis()
+    pipeline = r.pipeline(True)
+    pipeline.get(f"generation-{branch}")
+    pipeline.hgetall(f"mapping-{branch}")
+    pipeline.hgetall(f"profiles-{branch}")
+    pipeline.smembers(f"targets-{branch}")
+    generation, mapping, profiles, targets = pipeline.execute()
+
+    targets = sorted(map(lambda t: t.decode(), targets))
+    pipeline = r.pipeline(True)
+    pipeline.get(f"generation-{branch}")
+    for target in targets:
+        pipeline.smembers(f"packages-{branch}-{target}")
+    current_generation, *target_packages = pipeline.execute()
+
+    if current_generation != generation:
+        return load_index(branch)
+
+    packages = {}
+    for target, packages_target in zip(targets, target_packages):
+        packages[target] = frozenset(
+            map(lambda p: sys.intern(p.decode()), packages_target)
+        )
+
+    current_app.logger.info(
+        f"Loaded validation index of {branch} generation {int(generation or 0)}"
+    )
+
+    return {
+        "generation": int(generation or 0),
+        "mapping": {k.decode(): v.decode() for k, v in mapping.items()},
+        "profiles": {k.decode(): v.decode() for k, v in profiles.items()},
+        "packages": packages,
+    }
+
+
+def get_index(branch: str) -> dict:
+    """Return the in-memory validation index of a branch
+
+    The index is kept per worker process and only reloaded once the janitor
+    published a new generation. To avoid a Redis round trip per request the
+    generation is checked at most every `INDEX_CHECK_INTERVAL` seconds.
+
+    Args:
+        branch (str): Branch name as defined in VERSIONS
+
+    Returns:
+        dict: Validation index of the branch
+    """
+    indexes = current_app.extensions.setdefault("asu_index", {})
+    index = indexes.get(branch)
+    now = monotonic()
+
+    if index and now - index["checked_at"] < current_app.config["INDEX_CHECK_INTERVAL"]:
+        return index
+
+    if index:
+        generation = int(get_redis().get(f"generation-{branch}") or 0)
+        if generation == index["generation"]:
+            index["checked_at"] = now
+            return index
+
+    index = load_index(branch)
+    index["checked_at"] = now
+    indexes[branch] = index
+    return index
 
 
 def validate_request(request_data):
@@ -102,8 +221,6 @@ def validate_request(request_data):
             400,
         )
 
-    r = get_redis()
-
     if request_data["version"] != get_versions()[request_data["branch"]][
         "latest"
     ] and not get_versions()[request_data["branch"]].get("support_legacy_versions"):
@@ -117,16 +234,16 @@ def validate_request(request_data):
 
     current_app.logger.debug("Profile before mapping " + request_data["profile"])
 
-    mapped_profile = r.hget(
-        f"mapping-{request_data['branch']}", request_data["profile"],
-    )
+    index = get_index(request_data["branch"])
+
+    mapped_profile = index["mapping"].get(request_data["profile"])
 
     if mapped_profile:
-        request_data["profile"] = mapped_profile.decode()
+        request_data["profile"] = mapped_profile
 
     current_app.logger.debug("Profile after mapping " + request_data["profile"])
 
-    target = r.hget(f"profiles-{request_data['branch']}", request_data["profile"])
+    target = index["profiles"].get(request_data["profile"])
 
     if not target:
         return (
@@ -137,20 +254,16 @@ def validate_request(request_data):
             400,
         )
 
-    request_data["target"] = target.decode()
+    request_data["target"] = target
 
     if request_data.get("packages"):
-        request_data["packages"] = set(request_data["packages"]) - {"kernel", "libc"}
-
-        # store request packages temporary in Redis and create a diff
-        temp = str(uuid4())
-        pipeline = r.pipeline(True)
-        pipeline.sadd(temp, *set(map(lambda p: p.strip("-"), request_data["packages"])))
-        pipeline.expire(temp, 5)
-        pipeline.sdiff(
-            temp, f"packages-{request_data['branch']}-{request_data['target']}",
+        packages = set(map(str.strip, request_data["packages"]))
+        request_data["packages"] = packages - {"kernel", "libc", ""}
+
+        unknown_packages = sorted(
+            set(map(lambda p: p.strip("-"), request_data["packages"]))
+            - index["packages"].get(target, frozenset())
         )
-        unknown_packages = list(map(lambda p: p.decode(), pipeline.execute()[-1]))
 
         if unknown_packages:
             return (
@@ -166,20 +279,78 @@ def validate_request(request_data):
     return ({}, None)
 
 
+def conditional_response(
+    etag: str, render, status: int = 200, cache: bool = True
+) -> Response:
+    """Return a JSON response supporting conditional requests
+
+    Clients sending a matching `If-None-Match` header receive an empty `304`
+    response. Serialised bodies are cached per ETag, so unchanged responses
+    are serialised only once. The cache keeps up to `BODY_CACHE_SIZE` bodies.
+
+    Args:
+        etag (str): Strong ETag of the current representation
+        render (callable): Returns the response dict if not cached
+        status (int): Status code of the response
+        cache (bool): Cache the serialised body, disable for short lived bodies
+
+    Returns:
+        Response: Full or empty response containing the ETag
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    if not cache:
+        body = json.dumps(render())
+    else:
+        bodies = current_app.extensions.setdefault("asu_bodies", OrderedDict())
+        body = bodies.get(etag)
+        if body is None:
+            body = json.dumps(render())
+            bodies[etag] = body
+            while len(bodies) > current_app.config["BODY_CACHE_SIZE"]:
+                bodies.popitem(last=False)
+        else:
+            bodies.move_to_end(etag)
+
+    response = Response(body, status=status, mimetype="application/json")
+    response.set_etag(etag)
+    return response
+
+
 @bp.route("/versions")
 def api_versions():
     """API call to get available versions
 
+    The ETag changes with the generation of the configured versions, which is
+    calculated once per application.
+
     Returns:
-        dict: Available versions in JSON format
+        Response: Available versions in JSON format
     """
-    return current_app.config["VERSIONS"]
+    if "asu_versions_generation" not in current_app.extensions:
+        current_app.extensions["asu_versions_generation"] = get_str_hash(
+            json.dumps(current_app.config["VERSIONS"], sort_keys=True)
+        )
+
+    return conditional_response(
+        "versions-" + current_app.extensions["asu_versions_generation"],
+        lambda: current_app.config["VERSIONS"],
+    )
 
 
-def return_job(job):
+def return_job(job, store_path=None):
     """Return job status message and code
 
-    The states vary if the image is currently build, failed or finished
+    The states vary if the image is currently build, failed or finished. The
+    state loaded with the job is used, no further Redis requests are made.
+    Results of finished jobs are loaded from the `store_path`.
+
+    Args:
+        job (rq.job.Job): Job to return
+        store_path (Path): Path of stored images, defaults to `STORE_PATH`
 
     Returns:
         (dict, int): Status message and code
@@ -188,26 +359,89 @@ def return_job(job):
     if job.meta:
         response.update(job.meta)
 
-    if job.is_failed:
+    job_status = job.get_status(refresh=False)
+
+    if job_status == "failed":
         status = 500
         response["message"] = job.exc_info.strip().split("\n")[-1]
 
-    elif job.is_queued or job.is_started:
+    elif job_status in ("queued", "started"):
         status = 202
-        response = {"status": job.get_status()}
-
-    elif job.is_finished:
-        status = 200
-        response.update(job.result)
-        response["build_at"] = job.ended_at
+        response = {"status": job_status}
+        if "phase" in job.meta:
+            response["phase"] = job.meta["phase"]
+
+    elif job_status == "finished":
+        result = load_result(store_path or current_app.config["STORE_PATH"], job.result)
+        if result is None:
+            status = 404
+            response = {
+                "status": "expired",
+                "message": "Images were removed from the server",
+            }
+        else:
+            status = 200
+            response.update(result)
+            response["build_at"] = job.ended_at
 
     response["enqueued_at"] = job.enqueued_at
     response["request_hash"] = job.id
 
-    current_app.logger.debug(f"Response {response} with status {status}")
+    # also used by workers outside of an application context
+    if current_app:
+        current_app.logger.debug(f"Response {response} with status {status}")
     return response, status
 
 
+def wait_for_job(job, pubsub, timeout: float) -> bool:
+    """Block until the job changes its state or the timeout is reached
+
+    The pubsub must be subscribed to the job channel before calling, the job
+    state is read once afterwards, so a transition is never missed. Later it
+    is only read again once a message is published on the job channel.
+    Changes of the build phase are considered a state change as well.
+
+    Args:
+        job (rq.job.Job): job to wait for
+        pubsub (redis.client.PubSub): subscription of the job channel
+        timeout (float): maximum seconds to wait
+
+    Returns:
+        bool: True if the state changed
+    """
+    status = job.get_status(refresh=False)
+    phase = job.meta.get("phase")
+    if job.get_status() != status:
+        job.refresh()
+        return True
+
+    deadline = monotonic() + timeout
+    while True:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return False
+
+        if pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining):
+            job.refresh()
+            if (
+                job.get_status(refresh=False) != status
+                or job.meta.get("phase") != phase
+            ):
+                return True
+
+
+def is_pending(job) -> bool:
+    """Return if the job may still change its state
+
+    Args:
+        job (rq.job.Job): job to check
+
+    Returns:
+        bool: True if queued or started
+    """
+    return job.get_status(refresh=False) in ("queued", "started")
+
+
 @bp.route("/build/<request_hash>", methods=["GET"])
 def api_build_get(request_hash):
     """API call to get job information based on `request_hash`
@@ -215,17 +449,279 @@ def api_build_get(request_hash):
     This API call can be used for polling once the initial build request is
     accepted. The request using POST returns the `request_hash` on success.
 
+    Using the `wait` argument the call blocks until the job state changes,
+    at most for `wait` seconds limited by `LONG_POLL_TIMEOUT`.
+
     Args:
         request_hash (str): Request hash to lookup
 
+    Responses contain an ETag based on the job state, allowing clients to
+    use `If-None-Match` for conditional requests.
+
     Retrns:
-        (dict, int): Status message and code
+        Response: Status message and code
     """
-    job = get_queue().fetch_job(request_hash)
+    job = fetch_job(request_hash)
     if not job:
         return {"status": "not_found"}, 404
 
-    return return_job(job)
+    wait = min(
+        request.args.get("wait", 0, type=float),
+        current_app.config["LONG_POLL_TIMEOUT"],
+    )
+
+    if wait > 0 and is_pending(job):
+        pubsub = get_redis().pubsub()
+        pubsub.subscribe(get_channel(job.id))
+        try:
+            wait_for_job(job, pubsub, wait)
+        finally:
+            pubsub.close()
+
+    job_status = job.get_status(refresh=False)
+    if job_status in ("queued", "started"):
+        response, status = return_job(job)
+        if job_status == "queued":
+            response.update(get_queue_info(job))
+        # re-enqueued jobs keep their id, the ETag changes with `enqueued_at`
+        etag = (
+            f"{job.id}-{job.enqueued_at and job.enqueued_at.timestamp()}"
+            f"-{job_status}-{response.get('queue_position', 0)}"
+            f"-{response.get('phase', '')}"
+        )
+        # the body contains a changing `eta`, so it is not cached
+        return conditional_response(etag, lambda: response, status, cache=False)
+
+    response, status = return_job(job)
+    if status == 404:
+        # images removed from the store while the job is kept
+        return response, status
+
+    # finished and failed jobs only change once rebuilt
+    etag = f"{job.id}-{job_status}-{job.ended_at and job.ended_at.timestamp()}"
+    return conditional_response(etag, lambda: response, status)
+
+
+@bp.route("/build/<request_hash>/events", methods=["GET"])
+def api_build_events(request_hash):
+    """API call to stream job state transitions as server-sent events
+
+    Every state change results in a single event containing the same data as
+    returned by `/api/build/<request_hash>`. The stream ends once the job is
+    finished or failed.
+
+    Args:
+        request_hash (str): Request hash to lookup
+
+    Retrns:
+        Response: Event stream
+    """
+    job = fetch_job(request_hash)
+    if not job:
+        return {"status": "not_found"}, 404
+
+    pubsub = get_redis().pubsub()
+    pubsub.subscribe(get_channel(job.id))
+    keepalive = current_app.config["LONG_POLL_TIMEOUT"]
+
+    def events():
+        try:
+            while True:
+                response, status = return_job(job)
+                response["status_code"] = status
+                yield f"event: {job.get_status(refresh=False)}\n"
+                yield f"data: {json.dumps(response)}\n\n"
+
+                if not is_pending(job):
+                    break
+
+                while not wait_for_job(job, pubsub, keepalive):
+                    yield ": keepalive\n\n"
+        finally:
+            pubsub.close()
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        # deliver events immediately if proxied by nginx
+        headers={"X-Accel-Buffering": "no"},
+    )
+
+
+def get_ttl() -> tuple:
+    """Return the time to live of finished and failed jobs
+
+    Returns:
+        (int, int): Result and failure TTL in seconds
+    """
+    if not current_app.config["DEBUG"]:
+        return parse_timeout("24h"), parse_timeout("12h")
+    else:
+        return parse_timeout("15m"), parse_timeout("15m")
+
+
+def create_job(request_data: dict, request_hash: str) -> Job:
+    """Create a build job of a validated request
+
+    The job is not yet enqueued.
+
+    Args:
+        request_data (dict): Validated image request
+        request_hash (str): Canonical request hash used as job id
+
+    Returns:
+        Job: Build job
+    """
+    request_data["store_path"] = current_app.config["STORE_PATH"]
+    request_data["cache_path"] = current_app.config["CACHE_PATH"]
+    request_data["upstream_url"] = current_app.config["UPSTREAM_URL"]
+    request_data["api_path"] = current_app.config["API_PATH"]
+    request_data["upstream_ttl"] = current_app.config["UPSTREAM_TTL"]
+    request_data["json_path"] = current_app.config["JSON_PATH"]
+    request_data["resolve_manifest"] = current_app.config["RESOLVE_MANIFEST"]
+    request_data["stage_build"] = current_app.config["STAGE_BUILD"]
+    request_data["package_cache_size"] = current_app.config["PACKAGE_CACHE_SIZE"]
+    request_data["version_data"] = get_versions()[request_data["version"]]
+
+    result_ttl, failure_ttl = get_ttl()
+
+    return get_queue(request_data["target"]).create_job(
+        build,
+        args=(request_data,),
+        job_id=request_hash,
+        result_ttl=result_ttl,
+        failure_ttl=failure_ttl,
+        timeout=current_app.config["JOB_TIMEOUT"],
+    )
+
+
+def get_build_stats() -> dict:
+    """Return recently measured build durations and the amount of workers
+
+    Returns:
+        dict: Average build `duration` in seconds and amount of `workers`
+    """
+    pipeline = get_redis().pipeline(False)
+    pipeline.lrange("build-durations", 0, -1)
+    pipeline.scard("rq:workers")
+    durations, workers = pipeline.execute()
+
+    if durations:
+        duration = sum(map(float, durations)) / len(durations)
+    else:
+        duration = current_app.config["BUILD_DURATION_DEFAULT"]
+
+    return {"duration": duration, "workers": max(workers, 1)}
+
+
+def get_eta(position: int, stats: dict) -> int:
+    """Return estimated seconds until `position` jobs are processed
+
+    Args:
+        position (int): Amount of jobs to process
+        stats (dict): Build stats as returned by `get_build_stats`
+
+    Returns:
+        int: Estimated seconds
+    """
+    return max(ceil(position * stats["duration"] / stats["workers"]), 1)
+
+
+def get_queue_lengths() -> dict:
+    """Return the amount of queued jobs per queue
+
+    Returns:
+        dict: Queue length per queue name
+    """
+    names = [q.name for q in Queue.all(connection=get_redis())]
+    pipeline = get_redis().pipeline(False)
+    for name in names:
+        pipeline.llen(get_queue(name).key)
+    return dict(zip(names, pipeline.execute()))
+
+
+def check_admission(target: str, queue_lengths: dict, stats: dict = None) -> tuple:
+    """Check if another job of `target` may be enqueued
+
+    Each target queue is limited to `QUEUE_LENGTH_MAX` jobs, which can be
+    overwritten per target via `TARGET_QUEUE_LENGTH_MAX`. The total amount of
+    queued jobs is limited by `QUEUE_LENGTH_MAX_TOTAL`. Rejected requests
+    contain the estimated seconds until the queue is processed as
+    `retry_after`.
+
+    Args:
+        target (str): Target of the request
+        queue_lengths (dict): Queue lengths as returned by `get_queue_lengths`
+        stats (dict): Build stats as returned by `get_build_stats`, fetched
+                      if needed and not given
+
+    Returns:
+        (dict, int): Status message and code, empty if the job is admitted
+    """
+    limit = current_app.config["TARGET_QUEUE_LENGTH_MAX"].get(
+        target, current_app.config["QUEUE_LENGTH_MAX"]
+    )
+    queue_length = queue_lengths.get(target, 0)
+    if queue_length >= limit:
+        return (
+            {
+                "status": "queue_full",
+                "message": f"Too many queued builds for {target}",
+                "retry_after": get_eta(
+                    queue_length - limit + 1, stats or get_build_stats()
+                ),
+            },
+            429,
+        )
+
+    limit = current_app.config["QUEUE_LENGTH_MAX_TOTAL"]
+    queue_length = sum(queue_lengths.values())
+    if queue_length >= limit:
+        return (
+            {
+                "status": "overloaded",
+                "message": "Too many queued builds",
+                "retry_after": get_eta(
+                    queue_length - limit + 1, stats or get_build_stats()
+                ),
+            },
+            503,
+        )
+
+    return ({}, None)
+
+
+def get_queue_info(job) -> dict:
+    """Return position and estimated time until a queued job is started
+
+    Args:
+        job (rq.job.Job): Queued job
+
+    Returns:
+        dict: `queue_position` starting at 1 and `eta` in seconds
+    """
+    job_ids = get_queue(job.origin).get_job_ids()
+    if job.id not in job_ids:
+        return {}
+
+    position = job_ids.index(job.id) + 1
+    return {"queue_position": position, "eta": get_eta(position, get_build_stats())}
+
+
+def return_response(response: dict, status: int) -> tuple:
+    """Return response adding the Retry-After header if needed
+
+    Args:
+        response (dict): Status message
+        status (int): Status code
+
+    Returns:
+        (dict, int, dict): Status message, code and headers
+    """
+    headers = {}
+    if "retry_after" in response:
+        headers["Retry-After"] = str(response["retry_after"])
+    return response, status, headers
 
 
 @bp.route("/build", methods=["POST"])
@@ -253,34 +749,131 @@ def api_build():
     if not request_data:
         return {"status": "bad_request"}, 400
 
+    r = get_redis()
     request_hash = get_request_hash(request_data)
-    job = get_queue().fetch_job(request_hash)
-    response = {}
-    status = 200
-    if not current_app.config["DEBUG"]:
-        result_ttl = "24h"
-        failure_ttl = "12h"
-    else:
-        result_ttl = "15m"
-        failure_ttl = "15m"
+    canonical_hash = r.get(f"alias-{request_hash}")
+    job = fetch_job(canonical_hash.decode()) if canonical_hash else None
 
     if job is None:
         response, status = validate_request(request_data)
         if response:
             return response, status
 
-        request_data["store_path"] = current_app.config["STORE_PATH"]
-        request_data["cache_path"] = current_app.config["CACHE_PATH"]
-        request_data["upstream_url"] = current_app.config["UPSTREAM_URL"]
-        request_data["version_data"] = get_versions()[request_data["version"]]
-
-        job = get_queue().enqueue(
-            build,
-            request_data,
-            job_id=request_hash,
-            result_ttl=result_ttl,
-            failure_ttl=failure_ttl,
-            job_timeout="5m",
+        # identical images share a job independent of the raw request
+        canonical_hash = get_request_hash(get_canonical_request(request_data))
+        r.set(f"alias-{request_hash}", canonical_hash, ex=get_ttl()[0])
+        request_hash = canonical_hash
+        job = fetch_job(request_hash)
+
+    if job is None:
+        response, status = check_admission(request_data["target"], get_queue_lengths())
+        if response:
+            return return_response(response, status)
+
+        job = get_queue(request_data["target"]).enqueue_job(
+            create_job(request_data, request_hash)
         )
 
-    return return_job(job)
+    response, status = return_job(job)
+    if response.get("status") == "queued":
+        response.update(get_queue_info(job))
+
+    return response, status
+
+
+@bp.route("/build/batch", methods=["POST"])
+def api_build_batch():
+    """API call to request multiple images at once
+
+    The POSTed JSON data is a list of requests as accepted by `/api/build`.
+    Existing jobs are fetched and new jobs enqueued using a constant number of
+    Redis round trips, independent of the amount of requests.
+
+    Retrns:
+        (dict, int): List of status messages as `builds` and status code
+    """
+    requests_data = request.get_json()
+    if not requests_data or not isinstance(requests_data, list):
+        return {"status": "bad_request"}, 400
+
+    batch_size_max = current_app.config["BATCH_SIZE_MAX"]
+    if len(requests_data) > batch_size_max:
+        return (
+            {
+                "status": "bad_request",
+                "message": f"Batch exceeds {batch_size_max} requests",
+            },
+            400,
+        )
+
+    r = get_redis()
+    responses = [None] * len(requests_data)
+    raw_hashes = [None] * len(requests_data)
+
+    for i, request_data in enumerate(requests_data):
+        if isinstance(request_data, dict) and request_data:
+            raw_hashes[i] = get_request_hash(request_data)
+        else:
+            responses[i] = ({"status": "bad_request"}, 400)
+
+    # resolve known aliases and fetch their jobs
+    aliases = [f"alias-{h}" for h in raw_hashes if h]
+    canonical_hashes = iter(r.mget(aliases) if aliases else [])
+    request_hashes = []
+    for raw_hash in raw_hashes:
+        canonical_hash = next(canonical_hashes) if raw_hash else None
+        request_hashes.append(canonical_hash.decode() if canonical_hash else None)
+
+    known = list(set(filter(None, request_hashes)))
+    jobs = dict(zip(known, Job.fetch_many(known, connection=r)))
+
+    # validate all requests without existing job
+    pipeline = r.pipeline(False)
+    for i, request_data in enumerate(requests_data):
+        if responses[i] or jobs.get(request_hashes[i]):
+            continue
+
+        response, status = validate_request(request_data)
+        if response:
+            responses[i] = (response, status)
+            continue
+
+        request_hashes[i] = get_request_hash(get_canonical_request(request_data))
+        pipeline.set(f"alias-{raw_hashes[i]}", request_hashes[i], ex=get_ttl()[0])
+    pipeline.execute()
+
+    missing = list(
+        set(h for i, h in enumerate(request_hashes) if h and not responses[i])
+        - set(jobs.keys())
+    )
+    jobs.update(zip(missing, Job.fetch_many(missing, connection=r)))
+
+    # enqueue remaining requests within a single transaction
+    queue_lengths = get_queue_lengths()
+    stats = get_build_stats()
+    pipeline = r.pipeline(True)
+    for i, request_data in enumerate(requests_data):
+        if responses[i] or jobs.get(request_hashes[i]):
+            continue
+
+        response, status = check_admission(request_data["target"], queue_lengths, stats)
+        if response:
+            responses[i] = (response, status)
+            continue
+
+        queue_lengths[request_data["target"]] = (
+            queue_lengths.get(request_data["target"], 0) + 1
+        )
+
+        jobs[request_hashes[i]] = get_queue(request_data["target"]).enqueue_job(
+            create_job(request_data, request_hashes[i]), pipeline=pipeline
+        )
+    pipeline.execute()
+
+    builds = []
+    for i, request_hash in enumerate(request_hashes):
+        response, status = responses[i] or return_job(jobs[request_hash])
+        response["status_code"] = status
+        builds.append(response)
+
+    return {"builds": builds}, 200
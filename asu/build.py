@@ -1,18 +1,42 @@
+import urllib.error
 import urllib.request
+from collections import deque
+from contextlib import contextmanager
+import fcntl
+import gzip
+import hashlib
 import json
 from pathlib import Path
 import re
-from shutil import rmtree
+from shutil import rmtree, which
 import subprocess
+import tempfile
 import logging
+import os
+from time import monotonic
 
 from rq import get_current_job
 
-from .common import get_packages_hash, verify_usign, get_file_hash
+from .common import get_manifest_hash, verify_usign
+from .metrics import increment
+from .package_cache import use_package_cache
+from .resolver import resolve_manifest
+from .worker import get_warm_key, publish_status
 
 log = logging.getLogger("rq.worker")
 log.setLevel(logging.DEBUG)
 
+#: ImageBuilder directories written by `make image`, `packages` is included as
+#: its `Packages` index is regenerated in place
+MUTABLE_DIRS = ["bin", "build_dir", "dl", "packages", "tmp"]
+
+#: output lines of `make image` starting a build phase
+BUILD_PHASES = {
+    "Installing packages": "packages",
+    "Finalizing root filesystem": "rootfs",
+    "Building images": "image",
+}
+
 
 def build(request: dict):
     """Build image request and setup ImageBuilders automatically
@@ -39,6 +63,43 @@ def build(request: dict):
     target, subtarget = request["target"].split("/")
     sums_file = Path(cache / f"{subtarget}_sums")
     sig_file = Path(cache / f"{subtarget}_sums.sig")
+    labels = {"target": request["target"], "version": request["version"]}
+    timings = {}
+
+    @contextmanager
+    def timed(phase: str):
+        """Measure the duration of a build phase
+
+        Durations are stored as `timings` in the job meta, the worker adds
+        them to the metrics once the job finished or failed.
+
+        Args:
+            phase (str): name of the phase
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            timings[phase] = timings.get(phase, 0) + monotonic() - start
+            if job:
+                job.meta["timings"] = timings
+                job.save_meta()
+
+    def count_cache(cache_name: str, hit: bool, amount: int = 1):
+        """Count cache hits and misses
+
+        Args:
+            cache_name (str): name of the cache
+            hit (bool): True if the cache was hit
+            amount (int): amount of hits or misses
+        """
+        if job and amount:
+            increment(
+                job.connection,
+                "asu_cache_total",
+                dict(labels, cache=cache_name, result="hit" if hit else "miss"),
+                amount,
+            )
 
     def setup_ib():
         """Setup ImageBuilder based on `request`
@@ -46,17 +107,23 @@ def build(request: dict):
         This function downloads and verifies the ImageBuilder archive. Existing
         setups are automatically updated if newer version are available
         upstream.
+
+        Each ImageBuilder is installed in a directory named after the sha256sum
+        of its archive and activated by pointing `cache/<subtarget>` to it.
+        Already installed archives are activated without extracting them again.
         """
         log.debug("Setting up ImageBuilder")
-        if (cache / subtarget).is_dir():
-            rmtree(cache / subtarget)
+        if job:
+            increment(job.connection, "asu_imagebuilder_refreshes_total", labels)
 
-        download_file("sha256sums.sig", sig_file)
-        download_file("sha256sums", sums_file)
+        with timed("download"):
+            download_file("sha256sums.sig", sig_file)
+            download_file("sha256sums", sums_file)
 
-        assert verify_usign(
-            sig_file, sums_file, request["version_data"]["pubkey"]
-        ), "Bad signature for cheksums"
+        with timed("verify"):
+            assert verify_usign(
+                sig_file, sums_file, request["version_data"]["pubkey"]
+            ), "Bad signature for cheksums"
 
         # openwrt-imagebuilder-ath79-generic.Linux-x86_64.tar.xz
         ib_search = re.search(
@@ -69,34 +136,68 @@ def build(request: dict):
 
         ib_hash, ib_archive = ib_search.groups()
 
-        download_file(ib_archive)
+        install = cache / f"{subtarget}_installs" / ib_hash
 
-        assert ib_hash == get_file_hash(
-            cache / ib_archive
-        ), "Wrong ImageBuilder archive checksum"
+        count_cache("imagebuilder", install.is_dir())
+        if install.is_dir():
+            log.debug(f"ImageBuilder {ib_hash} already installed")
+            activate_install(cache / subtarget, install)
+            remove_unused_installs(cache / subtarget)
+            return
 
-        (cache / subtarget).mkdir(parents=True, exist_ok=True)
-        extract_archive = subprocess.run(
-            ["tar", "--strip-components=1", "-xf", ib_archive, "-C", subtarget],
-            cwd=cache,
-        )
+        temp = install.parent / f".{ib_hash}.{os.getpid()}"
+        temp.mkdir(parents=True, exist_ok=True)
 
-        assert not extract_archive.returncode, "Extracting ImageBuilder archive failed"
+        try:
+            with timed("extract"):
+                archive_hash = extract_stream(get_upstream_url(ib_archive), temp)
+            assert ib_hash == archive_hash, "Wrong ImageBuilder archive checksum"
+        except Exception:
+            rmtree(temp)
+            raise
 
         log.debug(f"Extracted TAR {ib_archive}")
 
-        (cache / ib_archive).unlink()
-
         extra_repos = request["version_data"].get("extra_repos")
         if extra_repos:
             log.debug("Found extra repos")
-            repos_path = cache / subtarget / "repositories.conf"
+            repos_path = temp / "repositories.conf"
             repos = repos_path.read_text()
             for name, repo in extra_repos.items():
                 repos += f"\nsrc/gz {name} {repo}"
             repos_path.write_text(repos)
             log.debug(f"Repos:\n{repos}")
 
+        (temp / ".lock").touch()
+
+        try:
+            temp.rename(install)
+        except OSError:
+            # installed concurrently by another worker
+            rmtree(temp)
+
+        activate_install(cache / subtarget, install)
+        remove_unused_installs(cache / subtarget)
+
+    def get_upstream_url(filename: str) -> str:
+        """Return URL of file in upstream target path
+
+        Args:
+            filename (str): File in upstream target folder
+
+        Returns:
+            str: URL of the file
+        """
+        return (
+            request["upstream_url"]
+            + "/"
+            + request["version_data"]["path"]
+            + "/targets/"
+            + request["target"]
+            + "/"
+            + filename
+        )
+
     def download_file(filename: str, dest: str = None):
         """Download file from upstream target path
 
@@ -109,31 +210,92 @@ def build(request: dict):
         """
         log.debug(f"Downloading {filename}")
         urllib.request.urlretrieve(
-            request["upstream_url"]
-            + "/"
-            + request["version_data"]["path"]
-            + "/targets/"
-            + request["target"]
-            + "/"
-            + filename,
-            dest or (cache / filename),
+            get_upstream_url(filename), dest or (cache / filename)
         )
 
+    def set_meta(bin_dir: Path):
+        """Point the job to the bin_dir containing images and buildlog
+
+        Args:
+            bin_dir (Path): relative path of the build within `store_path`
+        """
+        # check if running as job or within pytest
+        if job:
+            job.meta["bin_dir"] = str(bin_dir)
+            job.meta["buildlog"] = any(
+                (request["store_path"] / bin_dir / buildlog).is_file()
+                for buildlog in ["buildlog.txt.gz", "buildlog.txt"]
+            )
+            job.save_meta()
+
+    def run_image(
+        ib_path: Path, bin_dir: Path, extra_image_name: str = "", packages=None
+    ):
+        """Run `make image` storing images and buildlog in `bin_dir`
+
+        Args:
+            ib_path (Path): ImageBuilder working copy
+            bin_dir (Path): relative path of the build within `store_path`
+            extra_image_name (str): optional string added to image names
+            packages (list): packages expected to be installed, if known
+        """
+        with timed("image"), use_package_cache(
+            request["cache_path"] / "packages",
+            ib_path / "dl",
+            get_index_path(request),
+            request.get("package_cache_size", 0),
+            packages,
+        ) as package_stats:
+            returncode, tail = stream_build(
+                [
+                    "make",
+                    "image",
+                    f"PROFILE={request['profile']}",
+                    f"PACKAGES={' '.join(request['packages'])}",
+                    f"EXTRA_IMAGE_NAME={extra_image_name}",
+                    f"BIN_DIR={request['store_path'] / bin_dir}",
+                ],
+                ib_path,
+                request["store_path"] / bin_dir / "buildlog.txt.gz",
+                job,
+            )
+
+            # only packages installed by opkg count as cache hits
+            package_stats["installed"] = set()
+            for manifest_file in (request["store_path"] / bin_dir).glob("*.manifest"):
+                package_stats["installed"].update(
+                    parse_manifest(manifest_file.read_text())
+                )
+
+        count_cache("package", True, package_stats["hits"])
+        count_cache("package", False, package_stats["misses"])
+        set_meta(bin_dir)
+
+        if returncode:
+            log.error("Build output:\n" + "".join(tail))
+
+        assert not returncode, "ImageBuilder failed"
+
+        assert (
+            request["store_path"] / bin_dir / "profiles.json"
+        ).is_file(), "Image built but no profiles.json file created"
+
     cache.mkdir(parents=True, exist_ok=True)
 
     stamp_file = cache / f"{subtarget}_stamp"
 
-    sig_file_headers = urllib.request.urlopen(
-        request["upstream_url"]
-        + "/"
-        + request["version_data"]["path"]
-        + "/targets/"
-        + request["target"]
-        + "/sha256sums.sig"
-    ).info()
-    log.debug(f"sig_file_headers: \n{sig_file_headers}")
-
-    origin_modified = sig_file_headers.get("Last-Modified")
+    with timed("upstream_check"):
+        origin_modified = get_last_modified(
+            request["upstream_url"]
+            + "/"
+            + request["version_data"]["path"]
+            + "/targets/"
+            + request["target"]
+            + "/sha256sums.sig",
+            f"upstream-{request['version']}-{request['target']}",
+            job.connection if job else None,
+            request.get("upstream_ttl", 0),
+        )
     log.info("Origin %s", origin_modified)
 
     if stamp_file.is_file():
@@ -142,110 +304,717 @@ def build(request: dict):
     else:
         local_modified = ""
 
-    if origin_modified != local_modified:
+    if origin_modified != local_modified or not (cache / subtarget).exists():
         log.debug("New ImageBuilder upstream available")
         setup_ib()
 
     stamp_file.write_text(origin_modified)
 
-    if request.get("diff_packages", False) and request.get("packages"):
-        info_run = subprocess.run(
-            ["make", "info"], text=True, capture_output=True, cwd=cache / subtarget
-        )
-        default_packages = set(
-            re.search(r"Default Packages: (.*)\n", info_run.stdout).group(1).split()
-        )
-        profile_packages = set(
-            re.search(
-                r"{}:\n    .+\n    Packages: (.+?)\n".format(request["profile"]),
-                info_run.stdout,
-                re.MULTILINE,
+    if job:
+        job.connection.sadd(get_warm_key(), request["target"])
+
+    # keep the ImageBuilder while building, even if a newer one is activated
+    # and build in a private working copy, allowing concurrent builds
+    with use_install(cache / subtarget) as install, use_slot(install) as ib_path:
+        if request.get("diff_packages", False) and request.get("packages"):
+            info = get_info(install)
+            default_packages = set(info["default_packages"])
+            profile_packages = set(info["profiles"][request["profile"]]["packages"])
+            remove_packages = default_packages | profile_packages
+            remove_packages -= request["packages"]
+            request["packages"] = request["packages"] | set(
+                map(lambda p: f"-{p}", remove_packages)
+            )
+
+        manifest = None
+        if request.get("resolve_manifest"):
+            with timed("manifest"):
+                manifest = get_resolved_manifest(request, install)
+
+        if manifest is None and request.get("stage_build"):
+            # the manifest is taken from the image build itself
+            profile_dir = (
+                Path(request["version"]) / request["target"] / request["profile"]
             )
-            .group(1)
-            .split()
+            (request["store_path"] / profile_dir).mkdir(parents=True, exist_ok=True)
+            # unique within the store shared by workers of all hosts
+            staging_path = tempfile.mkdtemp(
+                prefix=".staging-", dir=request["store_path"] / profile_dir
+            )
+            # served by nginx once moved to the bin_dir
+            os.chmod(staging_path, 0o755)
+            staging_dir = profile_dir / Path(staging_path).name
+
+            run_image(ib_path, staging_dir)
+
+            manifest_files = list(
+                (request["store_path"] / staging_dir).glob("*.manifest")
+            )
+            assert manifest_files, "Image built but no manifest file created"
+            manifest = parse_manifest(manifest_files[0].read_text())
+            manifest_hash = get_manifest_hash(manifest)
+            log.debug(f"Manifest Hash {manifest_hash}")
+
+            bin_dir = staging_dir.parent / manifest_hash
+            move_staging(
+                request["store_path"], staging_dir, bin_dir, request["profile"]
+            )
+            set_meta(bin_dir)
+        else:
+            if manifest is None:
+                with timed("manifest"):
+                    manifest_run = subprocess.run(
+                        [
+                            "make",
+                            "manifest",
+                            f"PROFILE={request['profile']}",
+                            f"PACKAGES={' '.join(request['packages'])}",
+                        ],
+                        text=True,
+                        capture_output=True,
+                        cwd=ib_path,
+                    )
+
+                    if manifest_run.returncode:
+                        log.error(f"Manifest stdout {manifest_run.stdout}")
+                        log.error(f"Manifest stderr {manifest_run.stderr}")
+
+                    manifest = parse_manifest(manifest_run.stdout)
+
+            manifest_packages = manifest.keys()
+
+            log.debug(f"Manifest Packages: {manifest_packages}")
+
+            manifest_hash = get_manifest_hash(manifest)
+            log.debug(f"Manifest Hash {manifest_hash}")
+
+            bin_dir = (
+                Path(request["version"])
+                / request["target"]
+                / request["profile"]
+                / manifest_hash
+            )
+
+            (request["store_path"] / bin_dir).mkdir(parents=True, exist_ok=True)
+
+            reuse = is_artifact(request["store_path"], bin_dir, request["profile"])
+            count_cache("artifact", reuse)
+            if reuse:
+                log.info(f"Reuse existing image in {bin_dir}")
+                set_meta(bin_dir)
+                return store_result(
+                    request["store_path"], bin_dir, request["profile"], manifest
+                )
+
+            run_image(ib_path, bin_dir, manifest_hash, manifest_packages)
+
+            for manifest_file in (request["store_path"] / bin_dir).glob("*.manifest"):
+                image_manifest = parse_manifest(manifest_file.read_text())
+                if image_manifest != manifest:
+                    log.warning(f"Resolved manifest differs from image {manifest_file}")
+                    manifest = image_manifest
+                    # store the images under the hash of the installed packages,
+                    # other requests resolving the same manifest must not reuse it
+                    image_bin_dir = bin_dir.parent / get_manifest_hash(manifest)
+                    move_staging(
+                        request["store_path"],
+                        bin_dir,
+                        image_bin_dir,
+                        request["profile"],
+                    )
+                    bin_dir = image_bin_dir
+                    set_meta(bin_dir)
+                    break
+
+        result = store_result(
+            request["store_path"], bin_dir, request["profile"], manifest
         )
-        remove_packages = (default_packages | profile_packages) - request["packages"]
-        request["packages"] = request["packages"] | set(
-            map(lambda p: f"-{p}", remove_packages)
+
+        if job:
+            pipeline = job.connection.pipeline()
+            # most requested packages are prefetched into the package cache
+            for package in manifest.keys():
+                pipeline.zincrby("package-requests", 1, package)
+            pipeline.execute()
+
+        return result
+
+
+def stream_build(
+    command: list, cwd: Path, log_file: Path, job=None, tail_lines: int = 100
+) -> tuple:
+    """Run the ImageBuilder streaming its output to a compressed log file
+
+    Only the last `tail_lines` lines are kept in memory. Build phases found in
+    the output are stored as `phase` in the job meta and published to waiting
+    clients.
+
+    Args:
+        command (list): command to run
+        cwd (Path): ImageBuilder working copy
+        log_file (Path): gzip compressed log file, stdout and stderr combined
+        job (rq.job.Job): optional job to report the phase
+        tail_lines (int): amount of last lines to return
+
+    Returns:
+        (int, list): return code and last lines of the output
+    """
+    tail = deque(maxlen=tail_lines)
+
+    with gzip.open(log_file, "wt") as log_fd:
+        process = subprocess.Popen(
+            command,
+            cwd=cwd,
+            text=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
         )
+        for line in process.stdout:
+            log_fd.write(line)
+            tail.append(line)
 
-    manifest_run = subprocess.run(
-        [
-            "make",
-            "manifest",
-            f"PROFILE={request['profile']}",
-            f"PACKAGES={' '.join(request['packages'])}",
-        ],
-        text=True,
-        capture_output=True,
-        cwd=cache / subtarget,
-    )
+            for marker, phase in BUILD_PHASES.items():
+                if line.startswith(marker) and job:
+                    log.debug(f"Build phase {phase}")
+                    job.meta["phase"] = phase
+                    job.save_meta()
+                    publish_status(job)
+
+        returncode = process.wait()
+
+    return returncode, list(tail)
+
+
+def move_staging(store_path: Path, staging_dir: Path, bin_dir: Path, profile: str):
+    """Atomically move a staged build to its final bin_dir
+
+    Leftovers of failed builds in `bin_dir` are replaced. If a concurrent
+    build of the same manifest finished first, its images are kept and the
+    staged build is discarded. As `bin_dir` is named after the manifest hash
+    including package versions, only identical builds are discarded.
+
+    Args:
+        store_path (Path): base path of all images
+        staging_dir (Path): relative path of the staged build
+        bin_dir (Path): relative path of the final build
+        profile (str): requested profile
+    """
+    if is_artifact(store_path, bin_dir, profile):
+        log.info(f"Reuse existing image in {bin_dir}")
+        rmtree(store_path / staging_dir)
+        return
 
-    if manifest_run.returncode:
-        log.error(f"Manifest stdout {manifest_run.stdout}")
-        log.error(f"Manifest stderr {manifest_run.stderr}")
+    if (store_path / bin_dir).is_dir():
+        rmtree(store_path / bin_dir)
 
-    manifest = dict(map(lambda pv: pv.split(" - "), manifest_run.stdout.splitlines()))
+    try:
+        os.rename(store_path / staging_dir, store_path / bin_dir)
+    except OSError:
+        # moved concurrently by another worker
+        rmtree(store_path / staging_dir)
+        assert is_artifact(store_path, bin_dir, profile), "Moving staged build failed"
 
-    manifest_packages = manifest.keys()
 
-    log.debug(f"Manifest Packages: {manifest_packages}")
+def parse_manifest(manifest: str) -> dict:
+    """Parse a manifest as created by the ImageBuilder
 
-    packages_hash = get_packages_hash(manifest_packages)
-    log.debug(f"Packages Hash {packages_hash}")
+    Args:
+        manifest (str): lines of `<package> - <version>`
+
+    Returns:
+        dict: installed packages and their versions
+    """
+    return dict(map(lambda pv: pv.split(" - "), manifest.splitlines()))
+
+
+def get_index_path(request: dict) -> Path:
+    """Return the package index of the requested target written by the janitor
+
+    Args:
+        request (dict): build request
 
-    bin_dir = (
-        Path(request["version"])
+    Returns:
+        Path: `manifest.json` of the target
+    """
+    return (
+        Path(request.get("json_path", ""))
+        / request["version_data"]["path"]
         / request["target"]
-        / request["profile"]
-        / packages_hash
+        / "manifest.json"
     )
 
-    (request["store_path"] / bin_dir).mkdir(parents=True, exist_ok=True)
-
-    image_build = subprocess.run(
-        [
-            "make",
-            "image",
-            f"PROFILE={request['profile']}",
-            f"PACKAGES={' '.join(request['packages'])}",
-            f"EXTRA_IMAGE_NAME={packages_hash}",
-            f"BIN_DIR={request['store_path'] / bin_dir}",
-        ],
-        text=True,
-        capture_output=True,
-        cwd=cache / subtarget,
+
+def get_resolved_manifest(request: dict, ib_path: Path) -> dict:
+    """Resolve the manifest of a request using the package index of the janitor
+
+    This avoids running `make manifest`, which spawns opkg for every build.
+
+    Args:
+        request (dict): build request
+        ib_path (Path): ImageBuilder install
+
+    Returns:
+        dict: installed packages and their versions or None if the packages
+              could not be resolved
+    """
+    manifest_path = get_index_path(request)
+    if not manifest_path.is_file():
+        log.debug(f"No package index at {manifest_path}")
+        return None
+
+    info = get_info(ib_path)
+    packages = (
+        info["default_packages"]
+        + info["profiles"].get(request["profile"], {}).get("packages", [])
+        + list(request["packages"])
+        + ["kernel"]
     )
 
-    (request["store_path"] / bin_dir / "buildlog.txt").write_text(
-        f"### STDOUT\n\n{image_build.stdout}\n\n### STDERR\n\n{image_build.stderr}"
+    try:
+        return resolve_manifest(manifest_path, packages)
+    except AssertionError as e:
+        log.warning(f"Could not resolve manifest: {e}")
+        return None
+
+
+def get_decompressor(magic: bytes) -> list:
+    """Return tar arguments to decompress an archive based on its magic bytes
+
+    xz archives are decompressed by a separate multi-threaded `xz` process
+    if available.
+
+    Args:
+        magic (bytes): first bytes of the archive
+
+    Returns:
+        list: tar arguments
+    """
+    if magic.startswith(b"\xfd7zXZ\x00"):
+        if which("xz"):
+            return ["--use-compress-program=xz -T0"]
+        return ["--xz"]
+    elif magic.startswith(b"\x1f\x8b"):
+        return ["--gzip"]
+    return []
+
+
+def extract_stream(
+    url: str, dest: Path, chunk_size: int = 1024 * 1024, timeout: int = 60
+) -> str:
+    """Download, hash and extract an archive in a single pass
+
+    The archive is never written to disk, downloaded chunks are hashed and
+    passed directly to `tar`. Callers must verify the returned checksum
+    before using the extracted files. If the download fails `tar` is killed
+    and the error is raised.
+
+    Args:
+        url (str): archive to download
+        dest (Path): directory to extract the archive to
+        chunk_size (int): bytes read at once
+        timeout (int): seconds to wait for upstream per read
+
+    Returns:
+        str: sha256sum of the downloaded archive
+    """
+    log.debug(f"Downloading and extracting {url}")
+    h = hashlib.sha256()
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        chunk = response.read(chunk_size)
+        tar = subprocess.Popen(
+            ["tar", "--strip-components=1", "-x", "-C", dest, "-f", "-"]
+            + get_decompressor(chunk),
+            stdin=subprocess.PIPE,
+        )
+        try:
+            while chunk:
+                h.update(chunk)
+                tar.stdin.write(chunk)
+                chunk = response.read(chunk_size)
+        except BrokenPipeError:
+            pass
+        except BaseException:
+            tar.kill()
+            raise
+        finally:
+            try:
+                tar.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = tar.wait()
+
+    assert not returncode, "Extracting ImageBuilder archive failed"
+
+    return h.hexdigest()
+
+
+def get_last_modified(url: str, key: str, redis=None, ttl: int = 0) -> str:
+    """Return the Last-Modified header of an upstream file
+
+    The stamp is cached in the Redis hash `key` and shared by all workers.
+    Within `ttl` seconds the cached stamp is used without contacting
+    upstream, afterwards a single worker revalidates it using a conditional
+    HEAD request while others keep using the cached stamp.
+
+    Args:
+        url (str): upstream file to check
+        key (str): Redis key to cache the stamp
+        redis (Redis): optional connection, without the file is always checked
+        ttl (int): seconds until the stamp is revalidated
+
+    Returns:
+        str: Last-Modified header of the upstream file
+    """
+    cached = {}
+    if redis:
+        cached = {k.decode(): v.decode() for k, v in redis.hgetall(key).items()}
+        revalidate = redis.set(f"{key}-fresh", 1, ex=ttl, nx=True) if ttl else True
+        if cached and not revalidate:
+            log.debug(f"Use cached upstream stamp {cached['last_modified']}")
+            return cached["last_modified"]
+
+    headers = {}
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+
+    try:
+        response = urllib.request.urlopen(
+            urllib.request.Request(url, headers=headers, method="HEAD")
+        )
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        log.debug("Upstream not modified")
+        return cached["last_modified"]
+
+    log.debug(f"Upstream headers: \n{response.info()}")
+    stamp = {
+        "last_modified": response.info().get("Last-Modified", ""),
+        "etag": response.info().get("ETag", ""),
+    }
+
+    if redis:
+        redis.hmset(key, stamp)
+
+    return stamp["last_modified"]
+
+
+def parse_info(info: str) -> dict:
+    """Parse the output of `make info`
+
+    Args:
+        info (str): stdout of `make info`
+
+    Returns:
+        dict: `default_packages` and per profile `title`, `packages` and
+              `supported_devices`
+    """
+    index = {"default_packages": [], "profiles": {}}
+    profile = None
+
+    for line in info.splitlines():
+        if line.startswith("Default Packages:"):
+            index["default_packages"] = line.split(":", 1)[1].split()
+        elif line.startswith("    ") and profile is not None:
+            key, _, value = line.strip().partition(": ")
+            if key == "Packages":
+                profile["packages"] = value.split()
+            elif key == "SupportedDevices":
+                profile["supported_devices"] = value.split()
+            elif "title" not in profile:
+                profile["title"] = line.strip()
+        elif line.endswith(":") and not line.startswith("Available Profiles"):
+            profile = {"packages": [], "supported_devices": []}
+            index["profiles"][line[:-1]] = profile
+
+    return index
+
+
+def get_info(ib_path: Path) -> dict:
+    """Return the parsed `make info` output of an ImageBuilder
+
+    The output is the same for every build using the same ImageBuilder
+    install, it is therefore parsed once and stored as `info.json` within the
+    install.
+
+    Args:
+        ib_path (Path): ImageBuilder install
+
+    Returns:
+        dict: profile information as returned by `parse_info`
+    """
+    info_file = ib_path / "info.json"
+    if info_file.is_file():
+        return json.loads(info_file.read_text())
+
+    info_run = subprocess.run(
+        ["make", "info"], text=True, capture_output=True, cwd=ib_path
     )
+    assert not info_run.returncode, "Running make info failed"
 
-    # check if running as job or within pytest
-    if job:
-        job.meta["bin_dir"] = str(bin_dir)
-        job.meta["buildlog"] = True
-        job.save_meta()
+    info = parse_info(info_run.stdout)
+    temp_file = ib_path / f".info.json.{os.getpid()}"
+    temp_file.write_text(json.dumps(info, sort_keys=True))
+    os.replace(temp_file, info_file)
+
+    return info
 
-    if image_build.returncode:
-        log.error(f"Build stdout {image_build.stdout}")
-        log.error(f"Build stderr {image_build.stderr}")
 
-    assert not image_build.returncode, "ImageBuilder failed"
+def activate_install(current: Path, install: Path):
+    """Atomically point `current` to an ImageBuilder install
+
+    Builds already using the previous install are not affected.
+
+    Args:
+        current (Path): symlink used by new builds
+        install (Path): directory containing the ImageBuilder
+    """
+    if current.is_dir() and not current.is_symlink():
+        # ImageBuilder extracted by a previous version
+        rmtree(current)
+
+    temp = current.parent / f".{current.name}.{os.getpid()}"
+    os.symlink(install.relative_to(current.parent), temp)
+    os.replace(temp, current)
+    log.debug(f"Activated ImageBuilder {install}")
+
+
+@contextmanager
+def use_install(current: Path, attempts: int = 3):
+    """Use the active ImageBuilder install
+
+    A shared lock is held on the install while in use, so it is not removed
+    by `remove_unused_installs` even if a newer install is activated.
+
+    Args:
+        current (Path): symlink pointing to the active install
+        attempts (int): times to resolve the symlink if the install is removed
+
+    Yields:
+        Path: directory containing the ImageBuilder
+    """
+    lock = None
+    for _ in range(attempts):
+        install = current.resolve()
+        try:
+            lock = os.open(install / ".lock", os.O_RDONLY)
+        except FileNotFoundError:
+            # removed after resolving the symlink, resolve again
+            continue
 
-    json_file = Path(request["store_path"] / bin_dir / "profiles.json")
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        if (install / ".lock").exists():
+            break
+        os.close(lock)
+        lock = None
 
-    assert json_file.is_file(), "Image built but no profiles.json file created"
+    assert lock is not None, f"ImageBuilder install {current} is missing"
 
+    try:
+        yield install
+    finally:
+        os.close(lock)
+
+
+def create_slot(install: Path, slot: Path):
+    """Create a working copy of an ImageBuilder install
+
+    Files are hardlinked, directories modified by `make image` are copied,
+    using reflinks if supported by the file system.
+
+    Args:
+        install (Path): directory containing the ImageBuilder
+        slot (Path): directory of the working copy
+    """
+    temp = slot.parent / f".{slot.name}.{os.getpid()}"
+    if temp.is_dir():
+        rmtree(temp)
+
+    subprocess.run(["cp", "-al", install, temp], check=True)
+
+    for mutable_dir in MUTABLE_DIRS:
+        if (install / mutable_dir).is_dir():
+            rmtree(temp / mutable_dir)
+            subprocess.run(
+                ["cp", "-a", "--reflink=auto", install / mutable_dir, temp],
+                check=True,
+            )
+
+    os.rename(temp, slot)
+    log.debug(f"Created ImageBuilder slot {slot}")
+
+
+@contextmanager
+def use_slot(install: Path):
+    """Use a private working copy of an ImageBuilder install
+
+    Working copies are pooled in `.<install>_slots` next to the install and
+    reused by later builds. Each is locked exclusively while in use, a new one
+    is created if all are busy.
+
+    Args:
+        install (Path): directory containing the ImageBuilder
+
+    Yields:
+        Path: directory containing the working copy
+    """
+    slots = install.parent / f".{install.name}_slots"
+    slots.mkdir(exist_ok=True)
+
+    slot_id = 0
+    while True:
+        lock = os.open(slots / f"{slot_id}.lock", os.O_RDONLY | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            os.close(lock)
+            slot_id += 1
+
+    try:
+        slot = slots / str(slot_id)
+        if not slot.is_dir():
+            create_slot(install, slot)
+        yield slot
+    finally:
+        os.close(lock)
+
+
+def remove_unused_installs(current: Path):
+    """Remove ImageBuilder installs not active and not used by any build
+
+    Args:
+        current (Path): symlink pointing to the active install
+    """
+    active = current.resolve()
+    for install in (current.parent / f"{current.name}_installs").glob("[!.]*"):
+        if install == active:
+            continue
+
+        try:
+            lock = os.open(install / ".lock", os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            rmtree(install)
+            rmtree(install.parent / f".{install.name}_slots", ignore_errors=True)
+            log.debug(f"Removed unused ImageBuilder {install}")
+        except BlockingIOError:
+            log.debug(f"ImageBuilder {install} still in use")
+        finally:
+            os.close(lock)
+
+
+def store_result(store_path: Path, bin_dir: Path, profile: str, manifest: dict) -> dict:
+    """Store the build result next to the images
+
+    The full result contains the whole manifest and profile information. To
+    keep the job payload in Redis small it is stored once as `result.json` in
+    the bin_dir, the job only returns a pointer to it. An existing
+    `result.json` is only kept if it contains the same manifest.
+
+    Args:
+        store_path (Path): base path of all images
+        bin_dir (Path): relative path of the build within `store_path`
+        profile (str): requested profile
+        manifest (dict): installed packages and their versions
+
+    Returns:
+        dict: pointer to the result, see `load_result`
+    """
+    result_file = bin_dir / "result.json"
+
+    stored = load_result(store_path, {"result_file": str(result_file)})
+    if not stored or stored.get("manifest") != manifest:
+        json_content = get_result(
+            store_path / bin_dir / "profiles.json", profile, manifest
+        )
+        fd, temp_file = tempfile.mkstemp(
+            prefix=".result.json.", dir=store_path / bin_dir, text=True
+        )
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(json_content, sort_keys=True))
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, store_path / result_file)
+
+    return {"id": profile, "bin_dir": str(bin_dir), "result_file": str(result_file)}
+
+
+def load_result(store_path: Path, result: dict) -> dict:
+    """Load the build result a job returned
+
+    Args:
+        store_path (Path): base path of all images
+        result (dict): job result
+
+    Returns:
+        dict: full build result, None if it was removed from the store
+    """
+    if "result_file" not in result:
+        return result
+
+    try:
+        return json.loads((Path(store_path) / result["result_file"]).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def get_result(json_file: Path, profile: str, manifest: dict) -> dict:
+    """Return build result based on the created profiles.json
+
+    Args:
+        json_file (Path): profiles.json within the bin_dir
+        profile (str): requested profile
+        manifest (dict): installed packages and their versions
+
+    Returns:
+        dict: profile information merged with the manifest
+    """
     json_content = json.loads(json_file.read_text())
 
     assert (
-        request["profile"] in json_content["profiles"]
+        profile in json_content["profiles"]
     ), "Requested profile not in created profiles.json"
 
     json_content.update({"manifest": manifest})
-    json_content.update(json_content["profiles"][request["profile"]])
-    json_content["id"] = request["profile"]
+    json_content.update(json_content["profiles"][profile])
+    json_content["id"] = profile
     json_content.pop("profiles")
 
     return json_content
+
+
+def is_artifact(store_path: Path, bin_dir: Path, profile: str) -> bool:
+    """Check if the bin_dir already contains a finished image
+
+    The bin_dir is named after the manifest hash including package versions,
+    so different requests resolving to the same packages share it. An
+    existing `profiles.json` listing all image files marks a finished build.
+
+    Args:
+        store_path (Path): base path of all images
+        bin_dir (Path): relative path of the build within `store_path`
+        profile (str): requested profile
+
+    Returns:
+        bool: True if the image can be reused
+    """
+    json_file = store_path / bin_dir / "profiles.json"
+    found = False
+
+    if json_file.is_file():
+        images = (
+            json.loads(json_file.read_text())
+            .get("profiles", {})
+            .get(profile, {})
+            .get("images")
+        )
+        found = bool(images) and all(
+            (store_path / bin_dir / image["name"]).is_file() for image in images
+        )
+
+    return found
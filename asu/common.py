@@ -64,6 +64,31 @@ def get_request_hash(request_data: dict) -> str:
     return get_str_hash(" ".join(request_array), 12)
 
 
+def get_canonical_request(request_data: dict) -> dict:
+    """Return the canonical form of a validated image request
+
+    Requests for the same image may differ in profile aliases, package order,
+    whitespace or duplicates. The canonical form only contains the properties
+    influencing the resulting image in a normalised way.
+
+    Args:
+        request_data (dict): validated request with mapped profile
+
+    Returns:
+        dict: canonical request usable for `get_request_hash`
+    """
+    return {
+        "distro": request_data.get("distro", "openwrt").lower(),
+        "version": request_data.get("version", "").lower(),
+        "profile": request_data.get("profile", ""),
+        "packages": sorted(
+            set(filter(None, map(str.strip, request_data.get("packages", []))))
+            - {"kernel", "libc"}
+        ),
+        "diff_packages": bool(request_data.get("diff_packages", False)),
+    }
+
+
 def get_packages_hash(packages: list) -> str:
     """Return sha256sum of package list
 
@@ -79,6 +104,23 @@ def get_packages_hash(packages: list) -> str:
     return get_str_hash(" ".join(sorted(list(set(packages)))), 12)
 
 
+def get_manifest_hash(manifest: dict) -> str:
+    """Return sha256sum of a manifest
+
+    Package versions are included, so images of an updated ImageBuilder
+    installing other versions of the same packages get a different hash.
+
+    Args:
+        manifest (dict): installed packages and their versions
+
+    Returns:
+        str: hash of `manifest`
+    """
+    return get_str_hash(
+        " ".join(sorted(f"{name}={version}" for name, version in manifest.items())), 12
+    )
+
+
 def verify_usign(sig_file: Path, msg_file: Path, pub_key: str) -> bool:
     """Verify a signify/usign signature
 
@@ -1,43 +1,225 @@
 import re
 import urllib.request
 import requests
-
-from flask import current_app, Blueprint
-import email
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from time import time
+
+from flask import current_app, Blueprint, g
+from redis.exceptions import WatchError
+import gzip
+import hashlib
+import io
+import itertools
 import json
+import os
+
+from .package_cache import add_file, get_cache_file
 
 bp = Blueprint("janitor", __name__)
 
+#: seconds until data staged by an aborted update expires
+STAGING_EXPIRE = 24 * 60 * 60
+
+#: seconds until the update lock of a crashed janitor expires
+LOCK_EXPIRE = 60 * 60
+
 
 def get_redis():
     return current_app.config["REDIS_CONN"]
 
 
-def parse_packages_file(url, repo):
-    req = requests.get(url)
+def get_session() -> requests.Session:
+    """Return the HTTP session shared by all janitor threads
+
+    Connections are kept alive and reused. At most `JANITOR_HOST_CONNECTIONS`
+    requests run concurrently per host, further requests wait for a free
+    connection.
+
+    Returns:
+        requests.Session: shared session
+    """
+    if "asu_session" not in current_app.extensions:
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=current_app.config["JANITOR_HOST_CONNECTIONS"],
+            pool_block=True,
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        current_app.extensions["asu_session"] = session
+
+    return current_app.extensions["asu_session"]
 
-    if req.status_code != 200:
-        current_app.logger.warning(f"No Packages found at {url}")
-        return {}
 
+#: fields of Packages indexes stored by the janitor
+PACKAGE_FIELDS = {
+    "package",
+    "version",
+    "depends",
+    "provides",
+    "architecture",
+    "filename",
+    "size",
+    "sha256sum",
+    "description",
+}
+
+
+def parse_packages(lines, repo: str) -> dict:
+    """Parse a Packages index line by line
+
+    Field names are lower case with dashes replaced by underscores, only
+    `PACKAGE_FIELDS` are kept. Continuation lines are appended to the value of
+    the previous field.
+
+    Args:
+        lines (iterable): lines of the index
+        repo (str): repository name added to every package
+
+    Returns:
+        dict: packages by name
+    """
     packages = {}
-    linebuffer = ""
-    for line in req.text.splitlines():
-        if line == "":
-            parser = email.parser.Parser()
-            package = parser.parsestr(linebuffer)
-            package_name = package.get("Package")
-            if package_name:
-                packages[package_name] = dict(
-                    (name.lower().replace("-", "_"), val)
-                    for name, val in package.items()
-                )
-                packages[package_name]["repository"] = repo
+    package = {}
+    field = None
+
+    for line in itertools.chain(lines, [""]):
+        line = line.rstrip("\r\n")
+        if not line:
+            if "package" in package:
+                package["repository"] = repo
+                packages[package["package"]] = package
+            elif package:
+                current_app.logger.warning(f"Something wired about {package}")
+            package = {}
+            field = None
+        elif line[0] in " \t":
+            if field:
+                package[field] += "\n" + line
+        else:
+            name, _, value = line.partition(":")
+            field = name.lower().replace("-", "_")
+            if field in PACKAGE_FIELDS:
+                package[field] = value.lstrip(" \t")
             else:
-                print(f"Something wired about {package}")
-            linebuffer = ""
+                field = None
+
+    return packages
+
+
+def get_validators(url: str) -> dict:
+    """Return validators of an upstream index stored by the last run
+
+    Args:
+        url (str): URL of the index
+
+    Returns:
+        dict: `etag`, `last_modified` and content `hash`, empty if unknown
+    """
+    return {
+        k.decode(): v.decode() for k, v in get_redis().hgetall(f"index-{url}").items()
+    }
+
+
+def get_index(url: str, conditional: bool = False, stream: bool = False):
+    """Request an upstream index
+
+    Args:
+        url (str): URL of the index
+        conditional (bool): use validators of the last run
+        stream (bool): do not download the content immediately
+
+    Returns:
+        (requests.Response, dict): response and validators of the last run
+    """
+    validators = get_validators(url) if conditional else {}
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    return get_session().get(url, headers=headers, stream=stream), validators
+
+
+def store_validators(url: str, req, content_hash: str):
+    """Store validators of an upstream index for the next run
+
+    During `update_version` the validators are only collected and stored
+    together with the data of the version, otherwise a failed update would
+    skip the index on the next run.
+
+    Args:
+        url (str): URL of the index
+        req (requests.Response): response of the index
+        content_hash (str): sha256sum of the content
+    """
+    validators = {
+        "etag": req.headers.get("ETag", ""),
+        "last_modified": req.headers.get("Last-Modified", ""),
+        "hash": content_hash,
+    }
+    if "asu_validators" in current_app.extensions:
+        current_app.extensions["asu_validators"][url] = validators
+    else:
+        get_redis().hmset(f"index-{url}", validators)
+
+
+def parse_packages_file(url, repo, conditional=False):
+    """Download and parse a Packages index
+
+    The index is parsed while it is downloaded. Indexes ending with `.gz` are
+    decompressed on the fly.
+
+    Using `conditional` the index is only parsed if it changed since the last
+    run, based on the ETag, Last-Modified header and content hash.
+
+    A missing index is treated as empty repository, other errors are raised
+    so the previous packages are kept.
+
+    Args:
+        url (str): URL of the index
+        repo (str): repository name added to every package
+        conditional (bool): return None if the index is unchanged
+
+    Returns:
+        dict: packages by name, see `parse_packages`
+    """
+    req, validators = get_index(url, conditional, stream=True)
+    with req:
+        if req.status_code == 304:
+            current_app.logger.debug(f"Unchanged {url}")
+            return None
+
+        if req.status_code == 404:
+            current_app.logger.warning(f"No Packages found at {url}")
+            packages = {}
+            content_hash = "missing"
         else:
-            linebuffer += line + "\n"
+            req.raise_for_status()
+            req.raw.decode_content = True
+            # closed by the context manager, not while wrapped by TextIOWrapper
+            req.raw.auto_close = False
+            stream = gzip.GzipFile(fileobj=req.raw) if url.endswith(".gz") else req.raw
+            h = hashlib.sha256()
+
+            def hashed(lines):
+                for line in lines:
+                    h.update(line.encode("utf-8"))
+                    yield line
+
+            packages = parse_packages(
+                hashed(io.TextIOWrapper(stream, encoding="utf-8")), repo
+            )
+            content_hash = h.hexdigest()
+
+    store_validators(url, req, content_hash)
+    if conditional and validators.get("hash") == content_hash:
+        current_app.logger.debug(f"Unchanged {url}")
+        return None
 
     current_app.logger.debug(f"Found {len(packages)} in {repo}")
 
@@ -46,7 +228,7 @@ def parse_packages_file(url, repo):
 
 def get_targets(version):
     json_url = current_app.config["UPSTREAM_URL"]
-    req = requests.get(f"{json_url}/{version['path']}/targets/?json-targets")
+    req = get_session().get(f"{json_url}/{version['path']}/targets/?json-targets")
     if req.status_code != 200:
         current_app.logger.warning(f"No targets.json found for {version['name']}")
         return []
@@ -54,76 +236,399 @@ def get_targets(version):
     return req.json()
 
 
-def get_packages_target_base(version, target):
+def use_index(url: str) -> str:
+    """Record an index used by the target currently updated
+
+    If updating the target fails, the validators of all its indexes are
+    dropped, so the next run does not skip the target as unchanged.
+
+    Args:
+        url (str): URL of the index
+
+    Returns:
+        str: the given URL
+    """
+    if "asu_indexes" in g:
+        g.asu_indexes.add(url)
+    return url
+
+
+def get_packages_target_base(version, target, conditional=False):
     return parse_packages_file(
-        current_app.config["UPSTREAM_URL"]
-        + "/"
-        + version["path"]
-        + f"/targets/{target}/packages/Packages.manifest",
+        use_index(
+            current_app.config["UPSTREAM_URL"]
+            + "/"
+            + version["path"]
+            + f"/targets/{target}/packages/Packages.manifest"
+        ),
         target,
+        conditional,
     )
 
 
-def get_packages_arch_repo(version, arch, repo):
-    return parse_packages_file(
+def get_memoized(key: tuple, fetch) -> dict:
+    """Return packages of a repository shared by multiple targets
+
+    During `update_version` each repository is fetched and parsed once, all
+    targets using it share the result. Threads requesting a repository
+    currently fetched by another thread wait for its result.
+
+    Args:
+        key (tuple): identifies the repository
+        fetch (callable): returns the parsed packages
+
+    Returns:
+        dict: parsed packages, must not be modified, or None if unchanged
+    """
+    if "asu_repos" not in current_app.extensions:
+        return fetch()
+
+    repos, lock = current_app.extensions["asu_repos"]
+    with lock:
+        future = repos.get(key)
+        fetching = future is None
+        if fetching:
+            future = repos[key] = Future()
+
+    if fetching:
+        try:
+            future.set_result(fetch())
+        except Exception as e:
+            future.set_exception(e)
+
+    return future.result()
+
+
+def get_packages_arch_repo(version, arch, repo, conditional=False):
+    url = use_index(
         current_app.config["UPSTREAM_URL"]
         + "/"
         + version["path"]
-        + f"/packages/{arch}/{repo}/Packages.manifest",
-        repo,
+        + f"/packages/{arch}/{repo}/Packages.manifest"
+    )
+    return get_memoized(
+        (version["name"], arch, repo, conditional),
+        lambda: parse_packages_file(url, repo, conditional),
     )
 
 
-def update_version(version):
+@contextmanager
+def use_update_lock(version: dict):
+    """Hold the update lock of a version
+
+    Only a single janitor updates a version at a time. The lock expires after
+    `LOCK_EXPIRE` seconds in case the janitor crashes.
+
+    Args:
+        version (dict): Containing all version information as defined in VERSIONS
+
+    Yields:
+        bool: True if the lock was acquired
+    """
     r = get_redis()
+    key = f"janitor-lock-{version['name']}"
+    token = os.urandom(8).hex()
+    locked = r.set(key, token, ex=LOCK_EXPIRE, nx=True)
+    try:
+        yield bool(locked)
+    finally:
+        if locked:
+            with r.pipeline(True) as pipeline:
+                try:
+                    # release only if the lock did not expire meanwhile
+                    pipeline.watch(key)
+                    if pipeline.get(key) == token.encode():
+                        pipeline.multi()
+                        pipeline.delete(key)
+                        pipeline.execute()
+                except WatchError:
+                    pass
 
-    profiles = {"profiles": {}}
 
-    targets = list(
-        filter(
-            lambda p: not p.startswith("scheduled_for_removal"), get_targets(version)
+def update_version(version):
+    with use_update_lock(version) as locked:
+        if not locked:
+            current_app.logger.warning(
+                f"Skip {version['name']}, updated by another janitor"
+            )
+            return
+
+        r = get_redis()
+
+        profiles = {"profiles": {}}
+
+        targets = list(
+            filter(
+                lambda p: not p.startswith("scheduled_for_removal"),
+                get_targets(version),
+            )
         )
-    )
-    current_app.logger.info(f"Found {len(targets)} targets")
+        if not targets:
+            current_app.logger.warning(f"Keeping previous targets of {version['name']}")
+            return
+
+        current_app.logger.info(f"Found {len(targets)} targets")
+
+        known_targets = set(
+            map(lambda t: t.decode(), r.smembers(f"targets-{version['name']}"))
+        )
+        changed = known_targets != set(targets)
+        target_packages = {}
 
-    r.sadd(f"targets-{version['name']}", *targets)
+        profiles_path = (
+            current_app.config["JSON_PATH"] / version["path"] / "profiles.json"
+        )
+        previous = {"profiles": {}}
+        if profiles_path.is_file():
+            previous = json.loads(profiles_path.read_text())
+
+        app = current_app._get_current_object()
+
+        def update_target(target: str) -> tuple:
+            with app.app_context():
+                g.asu_indexes = set()
+                failed = set()
+                try:
+                    package_index = update_target_packages(version, target)
+                except requests.RequestException as e:
+                    # keep the previous packages instead of storing partial ones
+                    app.logger.warning(f"{target}: keeping previous packages, {e}")
+                    package_index = None
+                    failed = g.asu_indexes
+
+                try:
+                    result = update_target_profiles(
+                        version, target, conditional=profiles_path.is_file()
+                    )
+                except requests.RequestException as e:
+                    app.logger.warning(f"{target}: keeping previous profiles, {e}")
+                    result = None
+
+                return package_index, result, failed
+
+        # share repositories of the same architecture between targets
+        current_app.extensions["asu_repos"] = ({}, Lock())
+        validators = current_app.extensions["asu_validators"] = {}
+        failed = set()
+        try:
+            with ThreadPoolExecutor(current_app.config["JANITOR_WORKERS"]) as executor:
+                for target, (package_index, result, failed_indexes) in zip(
+                    targets, executor.map(update_target, targets)
+                ):
+                    changed |= package_index is not None or result is not None
+                    failed |= failed_indexes
+                    if package_index is not None:
+                        target_packages[target] = package_index
+                    if result is None:
+                        # unchanged or unavailable upstream, reuse the last run
+                        metadata = {
+                            k: v for k, v in previous.items() if k != "profiles"
+                        }
+                        profiles_target = {
+                            profile: data
+                            for profile, data in previous["profiles"].items()
+                            if data.get("target") == target
+                        }
+                    else:
+                        metadata, profiles_target = result
+
+                    profiles.update(metadata)
+                    profiles["profiles"].update(profiles_target)
+
+                    profiles.pop("target", None)
+        finally:
+            current_app.extensions.pop("asu_repos")
+            current_app.extensions.pop("asu_validators")
+
+        # indexes of failed targets are processed again by the next run
+        for url in failed:
+            validators[url] = None
+
+        if not changed:
+            current_app.logger.info(f"{version['name']} unchanged upstream")
+            store_validators_version(validators)
+            return
+
+        profiles_path.parent.mkdir(exist_ok=True, parents=True)
+
+        profiles_path.write_text(
+            json.dumps(profiles, sort_keys=True, separators=(",", ":"))
+        )
 
-    for target in targets:
-        update_target_packages(version, target)
-        metadata, profiles_target = update_target_profiles(version, target)
-        profiles.update(metadata)
-        profiles["profiles"].update(profiles_target)
+        mapping = {}
+        profile_targets = {}
+        for profile, data in profiles["profiles"].items():
+            for supported in data.get("supported_devices", []):
+                mapping[supported] = profile
+            profile_targets[profile] = data["target"]
+
+        store_version(
+            version,
+            {
+                f"targets-{version['name']}": targets,
+                f"mapping-{version['name']}": mapping,
+                f"profiles-{version['name']}": profile_targets,
+                **{
+                    f"packages-{version['name']}-{target}": package_index
+                    for target, package_index in target_packages.items()
+                },
+            },
+            [
+                f"packages-{version['name']}-{target}"
+                for target in known_targets - set(targets)
+            ],
+            validators,
+        )
 
-        profiles.pop("target", None)
 
-    profiles_path = current_app.config["JSON_PATH"] / version["path"] / "profiles.json"
-    profiles_path.parent.mkdir(exist_ok=True, parents=True)
+def store_validators_version(validators: dict, pipeline=None):
+    """Store validators collected during `update_version`
 
-    profiles_path.write_text(
-        json.dumps(profiles, sort_keys=True, separators=(",", ":"))
-    )
+    Args:
+        validators (dict): validators per URL, see `store_validators`, None
+                           to remove the validators of the URL
+        pipeline (Pipeline): transaction to add the commands to
+    """
+    redis = pipeline or get_redis().pipeline(False)
+    for url, url_validators in validators.items():
+        if url_validators is None:
+            redis.delete(f"index-{url}")
+        else:
+            redis.hmset(f"index-{url}", url_validators)
+    if not pipeline:
+        redis.execute()
+
+
+def store_version(version: dict, data: dict, removed: list, validators: dict):
+    """Replace the Redis data of a version at once
+
+    All data is first written to keys suffixed by the next generation, then
+    renamed to the keys read by the API within a single transaction. The API
+    therefore never sees a partially updated version. Staged keys expire
+    after `STAGING_EXPIRE` seconds in case the update is aborted.
+
+    If another janitor stored a generation meanwhile, the data is discarded.
+
+    Args:
+        version (dict): Containing all version information as defined in VERSIONS
+        data (dict): sets (as list) or hashes (as dict) to store per key
+        removed (list): keys to delete
+        validators (dict): validators of the fetched indexes, stored with the data
+    """
+    r = get_redis()
+    generation_key = f"generation-{version['name']}"
+    transaction = r.pipeline(True)
+    transaction.watch(generation_key)
+    generation = int(transaction.get(generation_key) or 0) + 1
+    suffix = f"@{generation}.{os.urandom(8).hex()}"
+
+    pipeline = r.pipeline(False)
+    for key, value in data.items():
+        staging_key = key + suffix
+        if not value:
+            continue
+        if isinstance(value, dict):
+            pipeline.hmset(staging_key, value)
+        else:
+            pipeline.sadd(staging_key, *value)
+        pipeline.expire(staging_key, STAGING_EXPIRE)
+    pipeline.execute()
+
+    transaction.multi()
+    for key, value in data.items():
+        if value:
+            transaction.rename(key + suffix, key)
+            transaction.persist(key)
+        else:
+            transaction.delete(key)
+    for key in removed:
+        transaction.delete(key)
+    store_validators_version(validators, transaction)
+    # signal API workers to reload their validation index
+    transaction.set(generation_key, generation)
+    try:
+        transaction.execute()
+    except WatchError:
+        current_app.logger.warning(
+            f"Discard {version['name']}, generation {generation} stored meanwhile"
+        )
+        r.delete(*(key + suffix for key, value in data.items() if value))
+        return
+    finally:
+        transaction.reset()
+
+    current_app.logger.info(f"Stored {version['name']} generation {generation}")
 
 
 def update_target_packages(version: dict, target: str):
+    """Update available packages of a target
+
+    Indexes are requested conditionally. If neither the target nor any of its
+    repositories changed upstream, nothing is written.
+
+    Args:
+        version (dict): Containing all version information as defined in VERSIONS
+        target (str): target to update
+
+    Returns:
+        list: names of available packages, None if unchanged
+    """
     current_app.logger.info(f"Updating packages of {version['name']}")
     r = get_redis()
 
-    packages = get_packages_target_base(version, target)
+    output_path = current_app.config["JSON_PATH"] / version["path"] / target
 
-    if not "base-files" in packages:
-        current_app.logger.warning(f"{target}: missing base-files package")
-        return
+    def get_packages(conditional: bool) -> tuple:
+        packages = get_packages_target_base(version, target, conditional)
+
+        if packages is None:
+            arch = r.hget(f"arch-{version['name']}", target)
+            if not arch:
+                return get_packages(False)
+            arch = arch.decode()
+        elif not "base-files" in packages:
+            current_app.logger.warning(f"{target}: missing base-files package")
+            return None, []
+        else:
+            arch = packages["base-files"]["architecture"]
+            r.hset(f"arch-{version['name']}", target, arch)
+
+        repos = [
+            get_packages_arch_repo(version, arch, repo, conditional)
+            for repo in ["base", "packages", "luci", "routing", "telephony", "freifunk"]
+        ]
+
+        for name, url in version.get("extra_repos", {}).items():
+            current_app.logger.debug(f"Update extra repo {name} at {url}")
+            repos.append(
+                get_memoized(
+                    (version["name"], name, url, conditional),
+                    lambda: parse_packages_file(
+                        use_index(f"{url}/Packages"), name, conditional
+                    ),
+                )
+            )
 
-    arch = packages["base-files"]["architecture"]
+        return packages, repos
 
-    for repo in ["base", "packages", "luci", "routing", "telephony", "freifunk"]:
-        packages.update(get_packages_arch_repo(version, arch, repo))
+    packages, repos = get_packages(
+        (output_path / "manifest.json").is_file()
+        and r.exists(f"packages-{version['name']}-{target}")
+    )
 
-    for name, url in version.get("extra_repos", {}).items():
-        current_app.logger.debug(f"Update extra repo {name} at {url}")
-        packages.update(parse_packages_file(f"{url}/Packages", name))
+    if packages is None and all(repo is None for repo in repos):
+        current_app.logger.info(f"{target}: packages unchanged")
+        return None
+
+    if packages is None or None in repos:
+        # some indexes changed, all are required to update the target
+        packages, repos = get_packages(False)
+        if packages is None:
+            return None
+
+    for repo in repos:
+        packages.update(repo)
 
-    output_path = current_app.config["JSON_PATH"] / version["path"] / target
     output_path.mkdir(exist_ok=True, parents=True)
 
     (output_path / "manifest.json").write_text(
@@ -137,38 +642,49 @@ def update_target_packages(version: dict, target: str):
     )
 
     current_app.logger.info(f"{target}: found {len(package_index)} packages")
-    r.sadd(f"packages-{version['name']}-{target}", *package_index)
+    return package_index
 
 
-def update_target_profiles(version: dict, target: str):
+def update_target_profiles(version: dict, target: str, conditional: bool = False):
     """Update available profiles of a specific version
 
     Args:
         version (dict): Containing all version information as defined in VERSIONS
+        target (str): target to update
+        conditional (bool): return None if profiles.json is unchanged upstream
+
+    Returns:
+        (dict, dict): metadata and profiles, None if unchanged or unavailable
     """
     current_app.logger.info(f"Updating profiles of {version['name']}")
-    r = get_redis()
-    req = requests.get(
+    url = (
         current_app.config["JSON_URL"]
         + "/"
         + version["path"]
         + f"/{target}/profiles.json"
     )
+    req, validators = get_index(url, conditional)
+
+    if req.status_code == 304:
+        current_app.logger.info(f"{target}: profiles unchanged")
+        return None
 
     if req.status_code != 200:
         current_app.logger.warning(f"Could not download profiles.json for {target}")
-        return {}, {}
+        return None
+
+    content_hash = hashlib.sha256(req.content).hexdigest()
+    store_validators(url, req, content_hash)
+    if conditional and validators.get("hash") == content_hash:
+        current_app.logger.info(f"{target}: profiles unchanged")
+        return None
 
     metadata = req.json()
     profiles = metadata.pop("profiles", {})
 
     current_app.logger.info(f"Found {len(profiles)} profiles")
 
-    for profile, data in profiles.items():
-        for supported in data.get("supported_devices", []):
-            r.hset(f"mapping-{version['name']}", supported, profile)
-        r.hset(f"profiles-{version['name']}", profile, target)
-
+    for data in profiles.values():
         data["target"] = target
 
     return metadata, profiles
@@ -190,3 +706,122 @@ def update():
 
         current_app.logger.info(f"Update {version['name']}")
         update_version(version)
+
+
+@bp.cli.command("cleanup")
+def cleanup():
+    """Remove static build responses of expired jobs
+
+    Workers store responses of finished builds as static files, these are
+    removed once the result TTL of the job passed.
+    """
+    r = get_redis()
+    now = time()
+
+    expired = r.zrangebyscore("static-results", "-inf", now)
+    for path in map(lambda p: Path(p.decode()), expired):
+        for static_file in [path, path.parent / f"{path.name}.gz"]:
+            try:
+                static_file.unlink()
+            except FileNotFoundError:
+                pass
+
+    r.zremrangebyscore("static-results", "-inf", now)
+    current_app.logger.info(f"Removed {len(expired)} expired static responses")
+
+
+def get_package_url(version: dict, target: str, arch: str, package: dict) -> str:
+    """Return the download URL of a package listed in a target manifest
+
+    Feed packages are stored below the architecture of the target, also if
+    they are marked as `Architecture: all`.
+
+    Args:
+        version (dict): Containing all version information as defined in VERSIONS
+        target (str): target the manifest belongs to
+        arch (str): package architecture of the target
+        package (dict): package as stored in `manifest.json`
+
+    Returns:
+        str: URL of the package file
+    """
+    repo = package["repository"]
+    if repo == target:
+        path = f"targets/{target}/packages"
+    elif repo in version.get("extra_repos", {}):
+        return f"{version['extra_repos'][repo]}/{package['filename']}"
+    else:
+        path = f"packages/{arch}/{repo}"
+
+    return (
+        f"{current_app.config['UPSTREAM_URL']}/{version['path']}/{path}/"
+        + package["filename"]
+    )
+
+
+@bp.cli.command("prefetch")
+def prefetch():
+    """Download the most requested packages into the package cache
+
+    Run this after `update` on build hosts, so new package versions are
+    downloaded before the first build requests them.
+    """
+    r = get_redis()
+    store = current_app.config["CACHE_PATH"] / "packages"
+    names = set(
+        map(
+            lambda p: p.decode(),
+            r.zrevrange(
+                "package-requests", 0, current_app.config["PACKAGE_PREFETCH"] - 1
+            ),
+        )
+    )
+
+    added = 0
+    for version in current_app.config["VERSIONS"]["branches"]:
+        if not version.get("enabled"):
+            continue
+
+        arches = {
+            k.decode(): v.decode()
+            for k, v in r.hgetall(f"arch-{version['name']}").items()
+        }
+        for target in sorted(
+            map(lambda t: t.decode(), r.smembers(f"targets-{version['name']}"))
+        ):
+            if target not in arches:
+                continue
+
+            manifest_path = (
+                current_app.config["JSON_PATH"]
+                / version["path"]
+                / target
+                / "manifest.json"
+            )
+            if not manifest_path.is_file():
+                continue
+
+            packages = json.loads(manifest_path.read_text())
+            for name in names & packages.keys():
+                package = packages[name]
+                if (
+                    "sha256sum" not in package
+                    or get_cache_file(store, package["sha256sum"]).exists()
+                ):
+                    continue
+
+                req = get_session().get(
+                    get_package_url(version, target, arches[target], package)
+                )
+                if req.status_code != 200:
+                    current_app.logger.warning(f"Could not download {name}")
+                    continue
+
+                temp = store / f".prefetch.{os.getpid()}"
+                store.mkdir(parents=True, exist_ok=True)
+                temp.write_bytes(req.content)
+                if add_file(store, temp, package["sha256sum"]):
+                    added += 1
+                temp.unlink()
+
+    current_app.logger.info(f"Prefetched {added} packages")
@@ -0,0 +1,112 @@
+from flask import Blueprint, Response, current_app
+
+bp = Blueprint("metrics", __name__)
+
+#: exported metrics and their type and description
+METRICS = {
+    "asu_build_phase_seconds": ("histogram", "Duration of build phases"),
+    "asu_builds_total": ("counter", "Finished and failed builds"),
+    "asu_cache_total": ("counter", "Cache hits and misses"),
+    "asu_imagebuilder_refreshes_total": ("counter", "ImageBuilder setups"),
+}
+
+#: upper bounds of histogram buckets in seconds
+BUCKETS = [0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+
+def get_labels(labels: dict) -> str:
+    """Return labels in the Prometheus text format
+
+    Args:
+        labels (dict): label names and values
+
+    Returns:
+        str: labels without braces, e.g. `target="x86/64",version="SNAPSHOT"`
+    """
+    return ",".join(f'{name}="{value}"' for name, value in sorted(labels.items()))
+
+
+def increment(redis, name: str, labels: dict, amount: int = 1):
+    """Increment a counter shared by all workers
+
+    Args:
+        redis (Redis): connection or pipeline
+        name (str): metric name as defined in `METRICS`
+        labels (dict): label names and values
+        amount (int): value to add
+    """
+    redis.hincrby(f"metrics-{name}", get_labels(labels), amount)
+
+
+def observe(redis, name: str, labels: dict, value: float):
+    """Add a value to a histogram shared by all workers
+
+    Bucket counters are stored cumulative, each observation increments all
+    buckets with an upper bound greater or equal the value.
+
+    Args:
+        redis (Redis): connection
+        name (str): metric name as defined in `METRICS`
+        labels (dict): label names and values
+        value (float): observed value
+    """
+    label_str = get_labels(labels)
+    pipeline = redis.pipeline()
+    for bucket in BUCKETS:
+        if value <= bucket:
+            pipeline.hincrby(f"metrics-{name}", f"bucket|{label_str}|{bucket}", 1)
+    pipeline.hincrby(f"metrics-{name}", f"count|{label_str}", 1)
+    pipeline.hincrbyfloat(f"metrics-{name}", f"sum|{label_str}", value)
+    pipeline.execute()
+
+
+def render_metrics(redis) -> str:
+    """Return all metrics in the Prometheus text format
+
+    Args:
+        redis (Redis): connection
+
+    Returns:
+        str: metrics of all workers
+    """
+    pipeline = redis.pipeline()
+    for name in METRICS:
+        pipeline.hgetall(f"metrics-{name}")
+
+    lines = []
+    for (name, (metric_type, description)), values in zip(
+        METRICS.items(), pipeline.execute()
+    ):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        values = {k.decode(): v.decode() for k, v in values.items()}
+
+        if metric_type == "counter":
+            for labels, value in sorted(values.items()):
+                lines.append(f"{name}{{{labels}}} {value}")
+            continue
+
+        for key in sorted(k for k in values if k.startswith("count|")):
+            labels = key.split("|", 1)[1]
+            prefix = f"{labels}," if labels else ""
+            for bucket in BUCKETS:
+                count = values.get(f"bucket|{labels}|{bucket}", 0)
+                lines.append(f'{name}_bucket{{{prefix}le="{bucket}"}} {count}')
+            lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {values[key]}')
+            lines.append(f"{name}_sum{{{labels}}} {values[f'sum|{labels}']}")
+            lines.append(f"{name}_count{{{labels}}} {values[key]}")
+
+    return "\n".join(lines) + "\n"
+
+
+@bp.route("/metrics")
+def metrics():
+    """Export build metrics collected by all workers
+
+    Returns:
+        Response: metrics in the Prometheus text format
+    """
+    return Response(
+        render_metrics(current_app.config["REDIS_CONN"]),
+        mimetype="text/plain; version=0.0.4",
+    )
@@ -0,0 +1,231 @@
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+import json
+import logging
+import os
+
+from .common import get_file_hash
+
+log = logging.getLogger("rq.worker")
+
+
+@lru_cache(maxsize=32)
+def load_checksums(path: str, mtime: float) -> dict:
+    """Load the package checksums of a package index written by the janitor
+
+    Args:
+        path (str): path to the `manifest.json` of a target
+        mtime (float): modification time of the file, used for caching
+
+    Returns:
+        dict: filename and sha256sum per package name
+    """
+    return {
+        name: (package["filename"], package["sha256sum"])
+        for name, package in json.loads(Path(path).read_text()).items()
+        if "filename" in package and "sha256sum" in package
+    }
+
+
+def get_checksums(manifest_path: Path) -> dict:
+    """Return the package checksums of a target, see `load_checksums`"""
+    if not manifest_path.is_file():
+        return {}
+    return load_checksums(str(manifest_path), manifest_path.stat().st_mtime)
+
+
+def get_cache_file(store: Path, sha256sum: str) -> Path:
+    """Return the path of a package within the cache
+
+    Args:
+        store (Path): package cache directory
+        sha256sum (str): checksum of the package
+
+    Returns:
+        Path: cached package file
+    """
+    return store / sha256sum[:2] / sha256sum
+
+
+def link_packages(store: Path, dl_dir: Path, checksums: dict) -> set:
+    """Link cached packages into the download directory of an ImageBuilder
+
+    opkg uses packages found in the download directory instead of fetching
+    them again.
+
+    Args:
+        store (Path): package cache directory
+        dl_dir (Path): download directory of the ImageBuilder
+        checksums (dict): sha256sum per package filename
+
+    Returns:
+        set: filenames of linked packages
+    """
+    dl_dir.mkdir(parents=True, exist_ok=True)
+
+    linked = set()
+    for filename, sha256sum in checksums.items():
+        if (dl_dir / filename).exists():
+            continue
+
+        try:
+            os.link(get_cache_file(store, sha256sum), dl_dir / filename)
+            linked.add(filename)
+        except FileNotFoundError:
+            # not cached or evicted concurrently
+            pass
+
+    log.debug(f"Linked {len(linked)} cached packages")
+    return linked
+
+
+def touch_packages(store: Path, sha256sums: list):
+    """Mark cached packages as recently used
+
+    Args:
+        store (Path): package cache directory
+        sha256sums (list): checksums of used packages
+    """
+    for sha256sum in sha256sums:
+        try:
+            os.utime(get_cache_file(store, sha256sum))
+        except FileNotFoundError:
+            # evicted concurrently
+            pass
+
+
+def add_file(store: Path, path: Path, sha256sum: str) -> bool:
+    """Add a file to the package cache after verifying its checksum
+
+    Args:
+        store (Path): package cache directory
+        path (Path): package file
+        sha256sum (str): expected checksum
+
+    Returns:
+        bool: True if the file was added
+    """
+    cache_file = get_cache_file(store, sha256sum)
+    if cache_file.exists() or get_file_hash(path) != sha256sum:
+        return False
+
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    temp = cache_file.parent / f".{sha256sum}.{os.getpid()}"
+    os.link(path, temp)
+    os.replace(temp, cache_file)
+    return True
+
+
+def store_packages(store: Path, dl_dir: Path, checksums: dict) -> int:
+    """Move packages downloaded by opkg into the package cache
+
+    Packages are only added if their checksum matches the package index. The
+    download directory is emptied afterwards.
+
+    Args:
+        store (Path): package cache directory
+        dl_dir (Path): download directory of the ImageBuilder
+        checksums (dict): sha256sum per package filename
+
+    Returns:
+        int: amount of added packages
+    """
+    added = 0
+    for path in dl_dir.glob("*.ipk"):
+        if path.name in checksums and add_file(store, path, checksums[path.name]):
+            added += 1
+        path.unlink()
+
+    log.debug(f"Added {added} packages to cache")
+    return added
+
+
+def evict_packages(store: Path, max_size: int):
+    """Remove least recently used packages until the cache fits `max_size`
+
+    Workers of the same host may evict concurrently, packages removed by
+    another worker meanwhile are skipped.
+
+    Args:
+        store (Path): package cache directory
+        max_size (int): size budget in bytes
+    """
+    files = []
+    for prefix in filter(Path.is_dir, store.iterdir()):
+        for path in prefix.iterdir():
+            if not path.name.startswith("."):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+    size = sum(f[1] for f in files)
+    for _, file_size, path in sorted(files):
+        if size <= max_size:
+            break
+        size -= file_size
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            continue
+        log.debug(f"Evicted cached package {path.name}")
+
+
+@contextmanager
+def use_package_cache(
+    store: Path, dl_dir: Path, manifest_path: Path, max_size: int, packages=None
+):
+    """Share downloaded packages between all ImageBuilders of a host
+
+    Packages are stored by their sha256sum as listed in the package index of
+    the janitor, so identical packages of different targets, ImageBuilder
+    versions and workers are only downloaded once.
+
+    Only cached `packages` are linked, all cached packages of the target if
+    these are unknown before the build. The caller sets `installed` in the
+    yielded dict to the names of the packages installed by opkg, only these
+    are counted as hits and marked as recently used.
+
+    Args:
+        store (Path): package cache directory
+        dl_dir (Path): download directory of the ImageBuilder
+        manifest_path (Path): `manifest.json` of the target
+        max_size (int): size budget in bytes, 0 disables the cache
+        packages (list): names of the packages to install, None if unknown
+
+    Yields:
+        dict: amount of cache `hits` and `misses`, set on exit
+    """
+    stats = {"hits": 0, "misses": 0, "installed": None}
+    index = get_checksums(manifest_path) if max_size else {}
+    if not index:
+        yield stats
+        return
+
+    if packages is not None:
+        packages = set(packages)
+    linked = link_packages(
+        store,
+        dl_dir,
+        {
+            filename: sha256sum
+            for name, (filename, sha256sum) in index.items()
+            if packages is None or name in packages
+        },
+    )
+    try:
+        yield stats
+    finally:
+        installed = stats["installed"]
+        used = [
+            sha256sum
+            for name, (filename, sha256sum) in index.items()
+            if filename in linked and (installed is None or name in installed)
+        ]
+        touch_packages(store, used)
+        stats["hits"] = len(used)
+        stats["misses"] = store_packages(store, dl_dir, dict(index.values()))
+        if stats["misses"]:
+            evict_packages(store, max_size)
@@ -0,0 +1,144 @@
+from functools import lru_cache
+from pathlib import Path
+import json
+import re
+
+
+def parse_depends(depends: str) -> list:
+    """Parse a Depends field of a Packages index
+
+    Version constraints are ignored, alternatives separated by `|` are kept in
+    their order.
+
+    Args:
+        depends (str): Depends field, e.g. `libc, busybox | busybox-selinux`
+
+    Returns:
+        list: list of alternatives per dependency
+    """
+    return [
+        [
+            re.sub(r"\s*\(.*\)", "", alternative).strip()
+            for alternative in dep.split("|")
+        ]
+        for dep in depends.split(",")
+        if dep.strip()
+    ]
+
+
+@lru_cache(maxsize=32)
+def load_index(path: str, mtime: float) -> dict:
+    """Load a package index as written by the janitor
+
+    The index is cached per path and modification time.
+
+    Args:
+        path (str): path to the `manifest.json` of a target
+        mtime (float): modification time of the file
+
+    Returns:
+        dict: `packages` with their versions and dependencies and the packages
+              `provides` per virtual package
+    """
+    manifest = json.loads(Path(path).read_text())
+    index = {"packages": {}, "provides": {}}
+
+    for name, package in manifest.items():
+        index["packages"][name] = {
+            "version": package.get("version", ""),
+            "depends": parse_depends(package.get("depends", "")),
+        }
+        for provided in parse_depends(package.get("provides", "")):
+            index["provides"].setdefault(provided[0], []).append(name)
+
+    for providers in index["provides"].values():
+        providers.sort()
+
+    return index
+
+
+def resolve(index: dict, packages: list) -> dict:
+    """Resolve the installed packages like opkg would do
+
+    Packages prefixed with `-` are removed from the list, like the ImageBuilder
+    does for default and profile packages. Virtual packages and alternatives
+    prefer packages already selected or explicitly requested.
+
+    Args:
+        index (dict): package index as returned by `load_index`
+        packages (list): requested packages
+
+    Returns:
+        dict: installed package names and their versions
+    """
+    removed = set(p[1:] for p in packages if p.startswith("-"))
+    requested = sorted(set(p for p in packages if not p.startswith("-")) - removed)
+
+    installed = {}
+
+    def select(name: str) -> str:
+        if name in index["packages"]:
+            return name
+
+        providers = index["provides"].get(name, [])
+        assert providers, f"Unknown package {name}"
+
+        for provider in providers:
+            if provider in installed:
+                return provider
+        for provider in providers:
+            if provider in requested:
+                return provider
+        return providers[0]
+
+    def is_satisfied(name: str) -> bool:
+        if name in installed:
+            return True
+        return any(p in installed for p in index["provides"].get(name, []))
+
+    queue = list(map(select, requested))
+    while queue:
+        name = queue.pop(0)
+        if name in installed:
+            continue
+
+        installed[name] = index["packages"][name]["version"]
+
+        for alternatives in index["packages"][name]["depends"]:
+            if any(map(is_satisfied, alternatives)):
+                continue
+
+            known = [
+                a
+                for a in alternatives
+                if a in index["packages"] or a in index["provides"]
+            ]
+            assert known, f"Unknown dependency {alternatives[0]} of {name}"
+            queue.append(select(known[0]))
+
+    return dict(sorted(installed.items()))
+
+
+@lru_cache(maxsize=1024)
+def _resolve_cached(path: str, mtime: float, packages: tuple) -> dict:
+    return resolve(load_index(path, mtime), packages)
+
+
+def resolve_manifest(manifest_path: Path, packages: list) -> dict:
+    """Return the manifest of an image without running the ImageBuilder
+
+    Results are memoised per index and package list.
+
+    Args:
+        manifest_path (Path): `manifest.json` of the target written by the
+                              janitor
+        packages (list): default, profile and requested packages
+
+    Returns:
+        dict: installed package names and their versions
+    """
+    return dict(
+        _resolve_cached(
+            str(manifest_path), manifest_path.stat().st_mtime, tuple(sorted(packages))
+        )
+    )
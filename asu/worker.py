@@ -0,0 +1,233 @@
+from pathlib import Path
+from socket import gethostname
+from time import time
+import gzip
+import os
+
+from flask import json
+
+from rq import Worker as BaseWorker
+from rq.defaults import DEFAULT_RESULT_TTL
+from rq.exceptions import DequeueTimeout
+from rq.worker import WorkerStatus
+
+from .metrics import increment, observe
+
+
+def get_channel(job_id: str) -> str:
+    """Return the Redis pub/sub channel of a job
+
+    Args:
+        job_id (str): job id, equals the request hash
+
+    Returns:
+        str: channel name
+    """
+    return f"job-{job_id}"
+
+
+def get_warm_key() -> str:
+    """Return the Redis key listing targets with an ImageBuilder on this host
+
+    All workers of a host share the same cache, the key is therefore based on
+    the hostname.
+
+    Returns:
+        str: Redis key of a set containing targets
+    """
+    return f"warm-{gethostname()}"
+
+
+def publish_status(job):
+    """Notify waiting API clients about a job state transition
+
+    Args:
+        job (rq.job.Job): job with changed state
+    """
+    job.connection.publish(get_channel(job.id), job.get_status(refresh=False))
+
+
+def write_atomic(path: Path, content: bytes):
+    """Write file atomically, readers never see partial content
+
+    Args:
+        path (Path): destination file
+        content (bytes): file content
+    """
+    temp = path.parent / f".{path.name}.{os.getpid()}"
+    temp.write_bytes(content)
+    os.replace(temp, path)
+
+
+def publish_result(job, default_result_ttl: int = DEFAULT_RESULT_TTL):
+    """Store the response of a finished build as static file
+
+    The response is written to `<api_path>/build/<request_hash>` including a
+    precompressed `.gz` variant, allowing a web server to answer polls without
+    reaching the application. Files are registered in the Redis sorted set
+    `static-results` and removed by the janitor once the job expired.
+
+    Args:
+        job (rq.job.Job): finished job
+        default_result_ttl (int): TTL used if the job defines none
+    """
+    from .api import return_job
+
+    if not job.args or not isinstance(job.args[0], dict):
+        return
+
+    api_path = job.args[0].get("api_path")
+    if not api_path or job.get_status(refresh=False) != "finished":
+        return
+
+    response, status = return_job(job, job.args[0]["store_path"])
+    if status != 200:
+        return
+
+    content = json.dumps(response).encode("utf-8")
+
+    build_path = Path(api_path) / "build"
+    build_path.mkdir(parents=True, exist_ok=True)
+    write_atomic(build_path / f"{job.id}.gz", gzip.compress(content))
+    write_atomic(build_path / job.id, content)
+
+    result_ttl = job.get_result_ttl(default_result_ttl)
+    expires = time() + result_ttl if result_ttl >= 0 else "+inf"
+    job.connection.zadd("static-results", {str(build_path / job.id): expires})
+
+
+def record_duration(job, samples: int = 100):
+    """Store the build duration for queue time estimations
+
+    Args:
+        job (rq.job.Job): finished job
+        samples (int): amount of recent durations to keep
+    """
+    if not job.started_at or not job.ended_at:
+        return
+
+    pipeline = job.connection.pipeline()
+    pipeline.lpush("build-durations", (job.ended_at - job.started_at).total_seconds())
+    pipeline.ltrim("build-durations", 0, samples - 1)
+    pipeline.execute()
+
+
+def record_metrics(job):
+    """Add the build result and phase durations of a job to the metrics
+
+    Args:
+        job (rq.job.Job): finished or failed job
+    """
+    if not job.args or not isinstance(job.args[0], dict):
+        return
+
+    labels = {"target": job.args[0]["target"], "version": job.args[0]["version"]}
+    increment(
+        job.connection,
+        "asu_builds_total",
+        dict(labels, status=job.get_status(refresh=False)),
+    )
+    for phase, duration in job.meta.get("timings", {}).items():
+        observe(
+            job.connection,
+            "asu_build_phase_seconds",
+            dict(labels, phase=phase),
+            duration,
+        )
+
+
+class Worker(BaseWorker):
+    """RQ worker publishing job state transitions
+
+    Notifications are sent after RQ persisted the new state, clients woken up
+    by them always read the updated job. Run via `rq worker -w asu.worker.Worker`.
+
+    Build jobs are enqueued in a queue per target. The worker prefers queues
+    of targets with an ImageBuilder already set up on this host, followed by
+    the queues given on the command line. Once these are empty jobs of all
+    other targets are taken, so no queue starves.
+    """
+
+    #: seconds to block on the queues before checking for new queues
+    queue_refresh_interval = 10
+
+    def __init__(self, queues, *args, **kwargs):
+        super().__init__(queues, *args, **kwargs)
+        self.static_queues = list(self.queues)
+
+    def get_affinity_queues(self) -> list:
+        """Return all queues ordered by preference of this worker
+
+        Returns:
+            list: Queues with warm targets first
+        """
+        warm = set(map(lambda t: t.decode(), self.connection.smembers(get_warm_key())))
+        known = set(
+            map(lambda q: q.name, self.queue_class.all(connection=self.connection))
+        )
+        static = list(map(lambda q: q.name, self.static_queues))
+
+        queue_names = (
+            sorted(warm & known - set(static))
+            + static
+            + sorted(known - warm - set(static))
+        )
+
+        return [
+            self.queue_class(name, connection=self.connection, job_class=self.job_class)
+            for name in queue_names
+        ]
+
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        """Dequeue the next job, preferring targets with warm ImageBuilders
+
+        Unlike the original implementation the list of queues is refreshed
+        every `queue_refresh_interval` seconds while waiting for jobs.
+        """
+        result = None
+
+        self.set_state(WorkerStatus.IDLE)
+
+        while True:
+            self.heartbeat()
+
+            if self.should_run_maintenance_tasks:
+                self.run_maintenance_tasks()
+
+            self.queues = self.get_affinity_queues()
+            qnames = ",".join(self.queue_names())
+            self.procline("Listening on " + qnames)
+
+            try:
+                result = self.queue_class.dequeue_any(
+                    self.queues,
+                    timeout and min(timeout, self.queue_refresh_interval),
+                    connection=self.connection,
+                    job_class=self.job_class,
+                )
+                if result is not None:
+                    job, queue = result
+                    self.log.info("%s: %s", queue.name, job.id)
+
+                break
+            except DequeueTimeout:
+                pass
+
+        self.heartbeat()
+        return result
+
+    def prepare_job_execution(self, job, heartbeat_ttl=None):
+        super().prepare_job_execution(job, heartbeat_ttl)
+        publish_status(job)
+
+    def handle_job_success(self, job, queue, started_job_registry):
+        super().handle_job_success(job, queue, started_job_registry)
+        record_duration(job)
+        record_metrics(job)
+        publish_result(job, self.default_result_ttl)
+        publish_status(job)
+
+    def handle_job_failure(self, job, started_job_registry=None, exc_string=""):
+        super().handle_job_failure(job, started_job_registry, exc_string)
+        record_metrics(job)
+        publish_status(job)
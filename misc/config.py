@@ -56,3 +56,20 @@ VERSIONS = {
         },
     ],
 }
+
+# resolve manifests from the janitor package index instead of running opkg
+# RESOLVE_MANIFEST = True
+
+# take the manifest from a single `make image` run in a staging directory
+# instead of running `make manifest` before, images are named without hash
+# STAGE_BUILD = True
+
+# bytes used by the package cache shared by all ImageBuilders, 0 disables it
+# PACKAGE_CACHE_SIZE = 10 * 1024 ** 3
+
+# amount of most requested packages downloaded by `flask janitor prefetch`
+# PACKAGE_PREFETCH = 100
+
+# targets updated concurrently by the janitor and connections per upstream host
+# JANITOR_WORKERS = 16
+# JANITOR_HOST_CONNECTIONS = 8
@@ -0,0 +1,129 @@
+"""Measure the duration of a janitor update against a local upstream
+
+A local HTTP server stands in for the upstream server. It serves a snapshot
+with `TARGETS` targets and delays every response by `LATENCY` seconds to
+simulate a remote server. The update runs once per given amount of janitor
+workers.
+
+    PYTHONPATH=. python misc/janitor_bench.py [workers ...]
+
+Set `REDIS_URL` to store the data in a Redis server, otherwise `fakeredis`
+from the development requirements is used.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import monotonic, sleep
+import json
+import logging
+import os
+import sys
+
+from asu import create_app
+from asu.janitor import update_version
+
+TARGETS = 40
+PACKAGES = 2000
+LATENCY = 0.05
+
+version = {"name": "snapshot", "path": "snapshots", "enabled": True}
+
+
+def get_packages(repo: str) -> str:
+    """Return a Packages index with `PACKAGES` packages"""
+    return "".join(
+        f"Package: {repo}-{i}\nVersion: 1.0-1\nDepends: libc\n"
+        f"Architecture: mips_24kc\nFilename: {repo}-{i}_1.0-1_mips_24kc.ipk\n"
+        f"SHA256sum: {i:064x}\nDescription: {repo} package {i}\n\n"
+        for i in range(PACKAGES)
+    )
+
+
+class Upstream(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        sleep(LATENCY)
+        if self.path.endswith("?json-targets"):
+            body = json.dumps([f"target{i}/generic" for i in range(TARGETS)])
+        elif "/targets/" in self.path and self.path.endswith("/Packages.manifest"):
+            body = (
+                "Package: base-files\nVersion: 1\nArchitecture: mips_24kc\n\n"
+                + get_packages("kmod")
+            )
+        elif self.path.endswith("/Packages.manifest"):
+            body = get_packages(self.path.split("/")[-2])
+        elif self.path.endswith("/profiles.json"):
+            target = "/".join(self.path.split("/")[-3:-1])
+            body = json.dumps(
+                {
+                    "target": target,
+                    "profiles": {
+                        f"{target}-device": {"supported_devices": [f"{target},device"]}
+                    },
+                }
+            )
+        else:
+            self.send_error(404)
+            return
+
+        content = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def get_redis():
+    if "REDIS_URL" in os.environ:
+        from redis import Redis
+
+        return Redis.from_url(os.environ["REDIS_URL"])
+
+    from fakeredis import FakeStrictRedis
+
+    return FakeStrictRedis()
+
+
+def measure(workers: int, url: str) -> float:
+    """Run a full update and return its duration in seconds"""
+    with TemporaryDirectory() as path:
+        app = create_app(
+            {
+                "JSON_PATH": path + "/json",
+                "REDIS_CONN": get_redis(),
+                "UPSTREAM_URL": url,
+                "JSON_URL": url,
+                "JANITOR_WORKERS": workers,
+            }
+        )
+        app.logger.setLevel(logging.ERROR)
+        with app.app_context():
+            start = monotonic()
+            update_version(version)
+            return monotonic() - start
+
+
+def main():
+    workers = list(map(int, sys.argv[1:])) or [1, 16]
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Upstream)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    print(f"{TARGETS} targets, {LATENCY * 1000:.0f} ms latency per request")
+    baseline = None
+    for count in workers:
+        duration = measure(count, url)
+        baseline = baseline or duration
+        print(f"{count:3} workers: {duration:6.2f}s ({baseline / duration:.1f}x)")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Report Redis bytes per build job
+
+Compares a job storing the full build result, as returned by builds before
+results were stored as `result.json` in the bin_dir, with a job storing only
+the pointer to that file.
+
+    python misc/job_size.py [path/to/result.json]
+
+Without argument the result is created from the test ImageBuilder. Set
+`REDIS_URL` to use another Redis server than `redis://localhost:6379`.
+"""
+
+from pathlib import Path
+import json
+import os
+import sys
+
+from redis import Redis
+from redis.exceptions import ResponseError
+from rq import Queue
+
+test_ib = (
+    Path(__file__).parent.parent
+    / "tests/upstream/snapshots/targets/testtarget/testsubtarget"
+    / "openwrt-imagebuilder-testtarget-testsubtarget.Linux-x86_64"
+)
+
+
+def get_test_result() -> dict:
+    """Return a build result based on the test ImageBuilder"""
+    profiles = json.loads((test_ib / "profiles.json").read_text())
+    manifest = dict(
+        map(
+            lambda pv: pv.split(" - "),
+            (test_ib / "openwrt-testtarget-testsubtarget-testprofile.manifest")
+            .read_text()
+            .splitlines(),
+        )
+    )
+    result = profiles.pop("profiles")["testprofile"]
+    result.update(profiles)
+    result["manifest"] = manifest
+    result["id"] = "testprofile"
+    return result
+
+
+def get_job_size(redis: Redis, job) -> int:
+    """Return the bytes used by a job hash in Redis"""
+    try:
+        return redis.memory_usage(job.key, samples=0)
+    except ResponseError:
+        # MEMORY is not available, sum up the stored values
+        return sum(map(len, redis.hgetall(job.key).values()))
+
+
+def measure(redis: Redis, result: dict) -> int:
+    """Store a finished job returning `result` and return its size"""
+    job = Queue("job-size", connection=redis).create_job("asu.build.build")
+    job._result = result
+    job.save()
+    size = get_job_size(redis, job)
+    job.delete()
+    return size
+
+
+def main():
+    if len(sys.argv) > 1:
+        result = json.loads(Path(sys.argv[1]).read_text())
+    else:
+        result = get_test_result()
+
+    bin_dir = "SNAPSHOT/testtarget/testsubtarget/testprofile/1753a287c647"
+    pointer = {
+        "id": result["id"],
+        "bin_dir": bin_dir,
+        "result_file": f"{bin_dir}/result.json",
+    }
+
+    redis = Redis.from_url(os.environ.get("REDIS_URL", "redis://localhost:6379"))
+    before = measure(redis, result)
+    after = measure(redis, pointer)
+
+    print(f"Full result:    {before} bytes per job")
+    print(f"Result pointer: {after} bytes per job")
+    print(f"Saved:          {before - after} bytes ({1 - after / before:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Measure the throughput of the Packages index parser
+
+Compares the parser of the janitor with the previous implementation based on
+`email.parser`, which is kept here for reference.
+
+    PYTHONPATH=. python misc/packages_bench.py [path/to/Packages]
+
+Without argument a synthetic index with `STANZAS` packages is parsed.
+"""
+
+from pathlib import Path
+from time import monotonic
+import email.parser
+import sys
+
+from asu.janitor import parse_packages
+
+STANZAS = 10000
+
+
+def get_index() -> str:
+    """Return a Packages index similar to the upstream `packages` feed"""
+    return "".join(
+        f"Package: package-{i}\n"
+        f"Version: 1.{i}-1\n"
+        "Depends: libc, libubox20191228, libuci20130104\n"
+        "License: GPL-2.0\n"
+        "Section: net\n"
+        "Architecture: mips_24kc\n"
+        "Installed-Size: 12345\n"
+        f"Filename: package-{i}_1.{i}-1_mips_24kc.ipk\n"
+        "Size: 13579\n"
+        f"SHA256sum: {i:064x}\n"
+        f"Description:  Package number {i}\n second description line\n\n"
+        for i in range(STANZAS)
+    )
+
+
+def parse_email(text: str, repo: str) -> dict:
+    """Previous parser, one `email.parser.Parser` per stanza"""
+    packages = {}
+    linebuffer = ""
+    for line in text.splitlines():
+        if line == "":
+            parser = email.parser.Parser()
+            package = parser.parsestr(linebuffer)
+            package_name = package.get("Package")
+            if package_name:
+                packages[package_name] = dict(
+                    (name.lower().replace("-", "_"), val)
+                    for name, val in package.items()
+                )
+                packages[package_name]["repository"] = repo
+            linebuffer = ""
+        else:
+            linebuffer += line + "\n"
+    return packages
+
+
+def measure(name: str, parse) -> float:
+    start = monotonic()
+    count = len(parse())
+    duration = monotonic() - start
+    print(f"{name:14} {count / duration:10.0f} stanzas/s ({duration:.2f}s)")
+    return duration
+
+
+def main():
+    if len(sys.argv) > 1:
+        text = Path(sys.argv[1]).read_text()
+    else:
+        text = get_index()
+
+    before = measure("email.parser", lambda: parse_email(text, "packages"))
+    after = measure(
+        "parse_packages", lambda: parse_packages(text.splitlines(True), "packages")
+    )
+    print(f"Speedup:       {before / after:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,15 @@ def test_get_packages_hash():
     assert get_packages_hash(["test1", "test2"]) == "57aab5949a36"
 
 
+def test_get_manifest_hash():
+    assert get_manifest_hash({"test1": "1", "test2": "1"}) != get_manifest_hash(
+        {"test1": "1", "test2": "2"}
+    )
+    assert get_manifest_hash({"test1": "1", "test2": "1"}) == get_manifest_hash(
+        {"test2": "1", "test1": "1"}
+    )
+
+
 def test_get_request_hash():
     request = {
         "distro": "test",
@@ -64,3 +73,19 @@ def test_verify_usign():
     os.close(sig_fd)
     os.unlink(msg_path)
     os.unlink(sig_path)
+
+
+def test_get_canonical_request():
+    request = {
+        "version": "SNAPSHOT",
+        "profile": "test",
+        "packages": {"test2", "test1 ", "kernel"},
+    }
+
+    assert get_canonical_request(request) == {
+        "distro": "openwrt",
+        "version": "snapshot",
+        "profile": "test",
+        "packages": ["test1", "test2"],
+        "diff_packages": False,
+    }
@@ -42,6 +42,7 @@ def app(redis):
     test_path = tempfile.mkdtemp()
     app = create_app(
         {
+            "API_PATH": test_path + "/api",
             "CACHE_PATH": test_path + "/cache",
             "JSON_PATH": test_path + "/json",
             "REDIS_CONN": redis,
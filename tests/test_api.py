@@ -1,3 +1,11 @@
+import threading
+import time
+
+from rq.job import Job
+
+import asu.api
+from asu.api import wait_for_job
+
 def test_api_version(client, app):
     response = client.get("/api/versions")
     assert response.json == app.config["VERSIONS"]
@@ -12,7 +20,7 @@ def test_api_build(client):
     )
     assert response.status == "202 ACCEPTED"
     assert response.json.get("status") == "queued"
-    assert response.json.get("request_hash") == "0af0c1a9ea31"
+    assert response.json.get("request_hash") == "aff7295b75b8"
 
 
 def test_api_build_mapping(client):
@@ -26,7 +34,7 @@ def test_api_build_mapping(client):
     )
     assert response.status == "202 ACCEPTED"
     assert response.json.get("status") == "queued"
-    assert response.json.get("request_hash") == "cfe4b87e4ec7"
+    assert response.json.get("request_hash") == "aff7295b75b8"
 
 
 def test_api_build_get(client):
@@ -36,10 +44,10 @@ def test_api_build_get(client):
             version="SNAPSHOT", profile="testprofile", packages=["test1", "test2"],
         ),
     )
-    response = client.get("/api/build/0af0c1a9ea31")
+    response = client.get("/api/build/aff7295b75b8")
     assert response.status == "202 ACCEPTED"
     assert response.json.get("status") == "queued"
-    assert response.json.get("request_hash") == "0af0c1a9ea31"
+    assert response.json.get("request_hash") == "aff7295b75b8"
 
 
 def test_api_build_get_not_found(client):
@@ -58,7 +66,7 @@ def test_api_build_empty_packages_list(client):
     )
     assert response.status == "202 ACCEPTED"
     assert response.json.get("status") == "queued"
-    assert response.json.get("request_hash") == "a86ba552b5f6"
+    assert response.json.get("request_hash") == "c7d7c8408124"
 
 
 def test_api_build_withouth_packages_list(client):
@@ -67,7 +75,7 @@ def test_api_build_withouth_packages_list(client):
     )
     assert response.status == "202 ACCEPTED"
     assert response.json.get("status") == "queued"
-    assert response.json.get("request_hash") == "a86ba552b5f6"
+    assert response.json.get("request_hash") == "c7d7c8408124"
 
 
 def test_api_build_bad_packages_str(client):
@@ -139,3 +147,370 @@ def test_api_build_bad_packages(client):
     assert response.json.get("message") == "Unsupported package(s): test4"
     assert response.json.get("status") == "bad_packages"
     assert response.status == "422 UNPROCESSABLE ENTITY"
+
+
+def test_load_index_shared_names(app, redis):
+    redis.sadd("targets-snapshot", "testtarget/other")
+    redis.sadd("packages-snapshot-testtarget/other", "test1")
+
+    with app.app_context():
+        index = asu.api.load_index("snapshot")
+
+    first, other = (
+        next(p for p in index["packages"][target] if p == "test1")
+        for target in ["testtarget/testsubtarget", "testtarget/other"]
+    )
+    assert first is other
+
+
+def test_api_build_index_generation(client, app, redis):
+    app.config["INDEX_CHECK_INTERVAL"] = 0
+    response = client.post(
+        "/api/build",
+        json=dict(version="SNAPSHOT", profile="testprofile", packages=["test4"]),
+    )
+    assert response.status == "422 UNPROCESSABLE ENTITY"
+
+    redis.sadd("packages-snapshot-testtarget/testsubtarget", "test4")
+    response = client.post(
+        "/api/build",
+        json=dict(version="SNAPSHOT", profile="testprofile", packages=["test4"]),
+    )
+    assert response.status == "422 UNPROCESSABLE ENTITY"
+
+    redis.incr("generation-snapshot")
+    response = client.post(
+        "/api/build",
+        json=dict(version="SNAPSHOT", profile="testprofile", packages=["test4"]),
+    )
+    assert response.status == "202 ACCEPTED"
+
+
+def test_api_build_canonical_packages(client):
+    response = client.post(
+        "/api/build",
+        json=dict(
+            version="snapshot",
+            profile="testvendor,testprofile",
+            packages=["test2", " test1", "test2", "kernel", "libc"],
+        ),
+    )
+    assert response.status == "202 ACCEPTED"
+    assert response.json.get("request_hash") == "aff7295b75b8"
+
+
+def test_api_build_alias(client, redis):
+    client.post(
+        "/api/build",
+        json=dict(
+            version="SNAPSHOT",
+            profile="testvendor,testprofile",
+            packages=["test1", "test2"],
+        ),
+    )
+    assert redis.get("alias-cfe4b87e4ec7") == b"aff7295b75b8"
+
+
+def test_api_build_get_wait(client, redis):
+    client.post(
+        "/api/build",
+        json=dict(
+            version="SNAPSHOT", profile="testprofile", packages=["test1", "test2"],
+        ),
+    )
+
+    def start():
+        time.sleep(0.2)
+        redis.hset("rq:job:aff7295b75b8", "status", "started")
+        redis.publish("job-aff7295b75b8", "started")
+
+    threading.Thread(target=start).start()
+    response = client.get("/api/build/aff7295b75b8?wait=5")
+    assert response.status == "202 ACCEPTED"
+    assert response.json.get("status") == "started"
+
+
+def test_api_build_get_wait_phase(client, redis):
+    client.post(
+        "/api/build",
+        json=dict(
+            version="SNAPSHOT", profile="testprofile", packages=["test1", "test2"],
+        ),
+    )
+    redis.hset("rq:job:aff7295b75b8", "status", "started")
+
+    def progress():
+        time.sleep(0.2)
+        job = Job.fetch("aff7295b75b8", connection=redis)
+        job.meta["phase"] = "packages"
+        job.save_meta()
+        redis.publish("job-aff7295b75b8", "started")
+
+    threading.Thread(target=progress).start()
+    response = client.get("/api/build/aff7295b75b8?wait=5")
+    assert response.status == "202 ACCEPTED"
+    assert response.json.get("phase") == "packages"
+
+
+def test_api_build_get_wait_timeout(client):
+    client.post(
+        "/api/build",
+        json=dict(
+            version="SNAPSHOT", profile="testprofile", packages=["test1", "test2"],
+        ),
+    )
+    response = client.get("/api/build/aff7295b75b8?wait=0.1")
+    assert response.status == "202 ACCEPTED"
+    assert response.json.get("status") == "queued"
+
+
+def test_wait_for_job_reads_state_once(client, redis):
+    client.post(
+        "/api/build",
+        json=dict(
+            version="SNAPSHOT", profile="testprofile", packages=["test1", "test2"],
+        ),
+    )
+    job = Job.fetch("aff7295b75b8", connection=redis)
+    pubsub = redis.pubsub()
+    pubsub.subscribe("job-aff7295b75b8")
+
+    reads = []
+    get_status = job.get_status
+
+    def counting_get_status(refresh=True):
+        reads.append(refresh)
+        return get_status(refresh)
+
+    job.get_status = counting_get_status
+    assert not wait_for_job(job, pubsub, 1.5)
+    assert reads.count(True) == 1
+    pubsub.close()
+
+
+def test_api_build_events(client, redis):
+    client.post(
+        "/api/build",
+        json=dict(
+            version="SNAPSHOT", profile="testprofile", packages=["test1", "test2"],
+        ),
+    )
+
+    def fail():
+        time.sleep(0.2)
+        redis.hset("rq:job:aff7295b75b8", "status", "started")
+        redis.publish("job-aff7295b75b8", "started")
+        time.sleep(0.2)
+        redis.hset("rq:job:aff7295b75b8", "exc_info", "Exception: ImageBuilder failed")
+        redis.hset("rq:job:aff7295b75b8", "status", "failed")
+        redis.publish("job-aff7295b75b8", "failed")
+
+    threading.Thread(target=fail).start()
+    response = client.get("/api/build/aff7295b75b8/events")
+    assert response.mimetype == "text/event-stream"
+    assert response.headers["X-Accel-Buffering"] == "no"
+    events = [
+        line.split(": ", 1)[1]
+        for line in response.get_data(as_text=True).splitlines()
+        if line.startswith("event: ")
+    ]
+    assert events == ["queued", "started", "failed"]
+
+
+def test_api_build_events_not_found(client):
+    response = client.get("/api/build/testtesttest/events")
+    assert response.status == "404 NOT FOUND"
+
+
+def test_api_build_batch(client, redis):
+    client.post(
+        "/api/build",
+        json=dict(version="SNAPSHOT", profile="testprofile", packages=["test1"]),
+    )
+    response = client.post(
+        "/api/build/batch",
+        json=[
+            dict(version="SNAPSHOT", profile="testprofile", packages=["test1"]),
+            dict(version="SNAPSHOT", profile="testprofile", packages=["test1", "test2"]),
+            dict(
+                version="SNAPSHOT",
+                profile="testvendor,testprofile",
+                packages=["test2", "test1"],
+            ),
+            dict(version="SNAPSHOT", profile="testprofile", packages=["test4"]),
+            "foobar",
+        ],
+    )
+    assert response.status == "200 OK"
+    builds = response.json["builds"]
+    assert len(builds) == 5
+    assert builds[0]["status_code"] == 202
+    assert builds[1]["status_code"] == 202
+    assert builds[1]["request_hash"] == "aff7295b75b8"
+    assert builds[2]["request_hash"] == "aff7295b75b8"
+    assert builds[3]["status_code"] == 422
+    assert builds[3]["status"] == "bad_packages"
+    assert builds[4]["status_code"] == 400
+    assert redis.llen("rq:queue:testtarget/testsubtarget") == 2
+
+    response = client.get("/api/build/aff7295b75b8")
+    assert response.status == "202 ACCEPTED"
+
+
+def test_api_build_batch_bad_request(client, app):
+    response = client.post("/api/build/batch", json=dict(version="SNAPSHOT"))
+    assert response.status == "400 BAD REQUEST"
+
+    app.config["BATCH_SIZE_MAX"] = 1
+    response = client.post(
+        "/api/build/batch",
+        json=[dict(version="SNAPSHOT", profile="testprofile")] * 2,
+    )
+    assert response.status == "400 BAD REQUEST"
+
+
+def test_api_build_queue_info(client, redis):
+    redis.lpush("build-durations", 30, 90)
+    response = client.post(
+        "/api/build",
+        json=dict(version="SNAPSHOT", profile="testprofile", packages=["test1"]),
+    )
+    assert response.json.get("queue_position") == 1
+    assert response.json.get("eta") == 60
+
+    response = client.post(
+        "/api/build",
+        json=dict(version="SNAPSHOT", profile="testprofile", packages=["test2"]),
+    )
+    assert response.json.get("queue_position") == 2
+    assert response.json.get("eta") == 120
+
+
+def test_api_build_queue_full(client, app):
+    app.config["QUEUE_LENGTH_MAX"] = 1
+    response = client.post(
+        "/api/build",
+        json=dict(version="SNAPSHOT", profile="testprofile", packages=["test1"]),
+    )
+    assert response.status == "202 ACCEPTED"
+
+    response = client.post(
+        "/api/build",
+        json=dict(version="SNAPSHOT", profile="testprofile", packages=["test2"]),
+    )
+    assert response.status == "429 TOO MANY REQUESTS"
+    assert response.json.get("status") == "queue_full"
+    assert response.headers["Retry-After"] == "60"
+
+    # existing jobs are still returned
+    response = client.post(
+        "/api/build",
+        json=dict(version="SNAPSHOT", profile="testprofile", packages=["test1"]),
+    )
+    assert response.status == "202 ACCEPTED"
+
+
+def test_api_build_overloaded(client, app):
+    app.config["QUEUE_LENGTH_MAX_TOTAL"] = 0
+    response = client.post(
+        "/api/build",
+        json=dict(version="SNAPSHOT", profile="testprofile", packages=["test1"]),
+    )
+    assert response.status == "503 SERVICE UNAVAILABLE"
+    assert response.json.get("status") == "overloaded"
+    assert "Retry-After" in response.headers
+
+
+def test_api_build_batch_queue_full(client, app):
+    app.config["QUEUE_LENGTH_MAX"] = 1
+    response = client.post(
+        "/api/build/batch",
+        json=[
+            dict(version="SNAPSHOT", profile="testprofile", packages=["test1"]),
+            dict(version="SNAPSHOT", profile="testprofile", packages=["test2"]),
+        ],
+    )
+    builds = response.json["builds"]
+    assert builds[0]["status_code"] == 202
+    assert builds[1]["status_code"] == 429
+
+
+def test_api_build_batch_queue_full_stats_once(client, app, monkeypatch):
+    app.config["QUEUE_LENGTH_MAX"] = 0
+    calls = []
+    get_build_stats = asu.api.get_build_stats
+
+    def counting_get_build_stats():
+        calls.append(True)
+        return get_build_stats()
+
+    monkeypatch.setattr("asu.api.get_build_stats", counting_get_build_stats)
+    response = client.post(
+        "/api/build/batch",
+        json=[
+            dict(version="SNAPSHOT", profile="testprofile", packages=[package])
+            for package in ["test1", "test2", "test3"]
+        ],
+    )
+    assert [b["status_code"] for b in response.json["builds"]] == [429] * 3
+    assert len(calls) == 1
+
+
+def test_api_version_etag(client, app):
+    response = client.get("/api/versions")
+    etag = response.headers["ETag"]
+    assert etag
+
+    response = client.get("/api/versions", headers={"If-None-Match": etag})
+    assert response.status == "304 NOT MODIFIED"
+    assert response.data == b""
+
+
+def test_api_build_get_expired(client, redis):
+    request_hash = client.post(
+        "/api/build",
+        json=dict(version="SNAPSHOT", profile="testprofile", packages=["test1"]),
+    ).json["request_hash"]
+    job = Job.fetch(request_hash, connection=redis)
+    job._result = {"id": "testprofile", "bin_dir": "x", "result_file": "x/result.json"}
+    job.set_status("finished")
+    job.save()
+
+    response = client.get(f"/api/build/{request_hash}")
+    assert response.status == "404 NOT FOUND"
+    assert response.json.get("status") == "expired"
+
+
+def test_api_build_get_etag(client, redis):
+    request_hash = client.post(
+        "/api/build",
+        json=dict(version="SNAPSHOT", profile="testprofile", packages=["test1"]),
+    ).json["request_hash"]
+    response = client.get(f"/api/build/{request_hash}")
+    etag = response.headers["ETag"]
+
+    response = client.get(f"/api/build/{request_hash}", headers={"If-None-Match": etag})
+    assert response.status == "304 NOT MODIFIED"
+
+    redis.hset(f"rq:job:{request_hash}", "status", "started")
+    response = client.get(f"/api/build/{request_hash}", headers={"If-None-Match": etag})
+    assert response.status == "202 ACCEPTED"
+    assert response.json.get("status") == "started"
+    assert response.headers["ETag"] != etag
+
+
+def test_api_build_get_requeued(app, client, redis):
+    request_hash = client.post(
+        "/api/build",
+        json=dict(version="SNAPSHOT", profile="testprofile", packages=["test1"]),
+    ).json["request_hash"]
+    response = client.get(f"/api/build/{request_hash}")
+    etag = response.headers["ETag"]
+    enqueued_at = response.json["enqueued_at"]
+    assert not app.extensions.get("asu_bodies")
+
+    redis.hset(f"rq:job:{request_hash}", "enqueued_at", "2030-01-01T00:00:00.000000Z")
+    response = client.get(f"/api/build/{request_hash}", headers={"If-None-Match": etag})
+    assert response.status == "202 ACCEPTED"
+    assert response.headers["ETag"] != etag
+    assert response.json["enqueued_at"] != enqueued_at
@@ -1,9 +1,29 @@
-from asu.build import build
+from asu.build import (
+    activate_install,
+    build,
+    extract_stream,
+    get_info,
+    get_last_modified,
+    load_result,
+    parse_info,
+    remove_unused_installs,
+    stream_build,
+    use_install,
+    use_slot,
+)
+from asu.common import get_manifest_hash
 from pathlib import Path
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
 
 import pytest
 
 from pytest_httpserver import HTTPServer
+from rq import Queue
 
 
 @pytest.fixture
@@ -139,3 +159,401 @@ def test_build_real(app, httpserver: HTTPServer):
     )
     result = build(request_data)
     assert result["id"] == "tplink_tl-wdr4300-v1"
+
+
+def test_build_fake_artifact_cache(app, upstream):
+    request_data = dict(
+        version_data={
+            "branch": "master",
+            "path": "snapshots",
+            "pubkey": "RWSrHfFmlHslUcLbXFIRp+eEikWF9z1N77IJiX5Bt/nJd1a/x+L+SU89",
+        },
+        target="testtarget/testsubtarget",
+        store_path=app.config["STORE_PATH"],
+        cache_path=app.config["CACHE_PATH"],
+        upstream_url="http://localhost:8001",
+        version="SNAPSHOT",
+        profile="testprofile",
+        packages={"test1", "test2"},
+    )
+    result = build(request_data)
+    assert result["id"] == "testprofile"
+
+    # a second `make image` would fail, the manifest resolves to the same image
+    makefile = app.config["CACHE_PATH"] / "SNAPSHOT/testtarget/testsubtarget/Makefile"
+    makefile.write_text(makefile.read_text().replace("image:\n", "image:\n\tfalse\n"))
+
+    request_data["packages"] = {"test1"}
+    result = build(request_data)
+    assert result["id"] == "testprofile"
+    assert "manifest" in load_result(app.config["STORE_PATH"], result)
+
+
+def test_build_fake_result_pointer(app, upstream):
+    request_data = dict(
+        version_data={
+            "branch": "master",
+            "path": "snapshots",
+            "pubkey": "RWSrHfFmlHslUcLbXFIRp+eEikWF9z1N77IJiX5Bt/nJd1a/x+L+SU89",
+        },
+        target="testtarget/testsubtarget",
+        store_path=app.config["STORE_PATH"],
+        cache_path=app.config["CACHE_PATH"],
+        upstream_url="http://localhost:8001",
+        version="SNAPSHOT",
+        profile="testprofile",
+    )
+    result = build(request_data)
+    assert set(result.keys()) == {"id", "bin_dir", "result_file"}
+
+    json_content = load_result(app.config["STORE_PATH"], result)
+    assert json_content["id"] == "testprofile"
+    assert json_content["manifest"]["busybox"] == "1.31.1-1"
+    assert json_content["images"][0]["type"] == "sysupgrade"
+
+
+def test_build_fake_updated_versions(app, upstream):
+    request_data = dict(
+        version_data={
+            "branch": "master",
+            "path": "snapshots",
+            "pubkey": "RWSrHfFmlHslUcLbXFIRp+eEikWF9z1N77IJiX5Bt/nJd1a/x+L+SU89",
+        },
+        target="testtarget/testsubtarget",
+        store_path=app.config["STORE_PATH"],
+        cache_path=app.config["CACHE_PATH"],
+        upstream_url="http://localhost:8001",
+        version="SNAPSHOT",
+        profile="testprofile",
+    )
+    result = build(dict(request_data))
+
+    # an updated ImageBuilder installs other versions of the same packages
+    manifest_file = (
+        app.config["CACHE_PATH"]
+        / "SNAPSHOT/testtarget/testsubtarget"
+        / "openwrt-testtarget-testsubtarget-testprofile.manifest"
+    )
+    manifest_file.write_text(
+        manifest_file.read_text().replace("busybox - 1.31.1-1", "busybox - 1.32.0-1")
+    )
+
+    updated = build(dict(request_data))
+    assert updated["bin_dir"] != result["bin_dir"]
+    json_content = load_result(app.config["STORE_PATH"], updated)
+    assert json_content["manifest"]["busybox"] == "1.32.0-1"
+
+
+def test_build_fake_resolve_manifest(app, upstream):
+    ib_path = Path(
+        "./tests/upstream/snapshots/targets/testtarget/testsubtarget/"
+        "openwrt-imagebuilder-testtarget-testsubtarget.Linux-x86_64"
+    )
+    image_manifest = dict(
+        map(
+            lambda pv: pv.split(" - "),
+            (ib_path / "openwrt-testtarget-testsubtarget-testprofile.manifest")
+            .read_text()
+            .splitlines(),
+        )
+    )
+    index = {name: {"version": version} for name, version in image_manifest.items()}
+    index["base-files"]["provides"] = "libgcc, kmod-ath9k, kmod-usb-chipidea2"
+    index["kmod-usb-storage"] = {"version": "1"}
+
+    manifest_path = (
+        app.config["JSON_PATH"] / "snapshots/testtarget/testsubtarget/manifest.json"
+    )
+    manifest_path.parent.mkdir(parents=True)
+    manifest_path.write_text(json.dumps(index))
+
+    request_data = dict(
+        version_data={
+            "branch": "master",
+            "path": "snapshots",
+            "pubkey": "RWSrHfFmlHslUcLbXFIRp+eEikWF9z1N77IJiX5Bt/nJd1a/x+L+SU89",
+        },
+        target="testtarget/testsubtarget",
+        store_path=app.config["STORE_PATH"],
+        cache_path=app.config["CACHE_PATH"],
+        json_path=app.config["JSON_PATH"],
+        resolve_manifest=True,
+        upstream_url="http://localhost:8001",
+        version="SNAPSHOT",
+        profile="testprofile",
+        packages={"busybox"},
+    )
+    result = build(request_data)
+
+    # make manifest did not run, the resolved manifest lacks swconfig, so the
+    # image is moved to the hash of the packages installed by opkg
+    profile_path = (
+        app.config["STORE_PATH"] / "SNAPSHOT/testtarget/testsubtarget/testprofile"
+    )
+    manifest_hash = get_manifest_hash(image_manifest)
+    assert result["bin_dir"].endswith(manifest_hash)
+    assert [p.name for p in profile_path.iterdir()] == [manifest_hash]
+    assert load_result(app.config["STORE_PATH"], result)["manifest"] == image_manifest
+
+
+def test_build_fake_stage_build(app, upstream):
+    request_data = dict(
+        version_data={
+            "branch": "master",
+            "path": "snapshots",
+            "pubkey": "RWSrHfFmlHslUcLbXFIRp+eEikWF9z1N77IJiX5Bt/nJd1a/x+L+SU89",
+        },
+        target="testtarget/testsubtarget",
+        store_path=app.config["STORE_PATH"],
+        cache_path=app.config["CACHE_PATH"],
+        stage_build=True,
+        upstream_url="http://localhost:8001",
+        version="SNAPSHOT",
+        profile="testprofile",
+        packages={"test1", "test2"},
+    )
+    profile_path = (
+        app.config["STORE_PATH"] / "SNAPSHOT/testtarget/testsubtarget/testprofile"
+    )
+    # build of a worker on another host with the same pid
+    (profile_path / f".staging-{os.getpid()}").mkdir(parents=True)
+
+    result = build(dict(request_data))
+    assert (
+        result["bin_dir"]
+        == "SNAPSHOT/testtarget/testsubtarget/testprofile/1753a287c647"
+    )
+
+    assert sorted(p.name for p in profile_path.iterdir()) == [
+        f".staging-{os.getpid()}",
+        "1753a287c647",
+    ]
+    assert (profile_path / "1753a287c647").stat().st_mode & 0o777 == 0o755
+    assert (profile_path / "1753a287c647/result.json").stat().st_mode & 0o777 == 0o644
+    assert (profile_path / "1753a287c647/buildlog.txt.gz").is_file()
+    assert (
+        load_result(app.config["STORE_PATH"], result)["manifest"]["busybox"]
+        == "1.31.1-1"
+    )
+
+    # an existing build of the same manifest is kept
+    assert build(dict(request_data)) == result
+    assert sorted(p.name for p in profile_path.iterdir()) == [
+        f".staging-{os.getpid()}",
+        "1753a287c647",
+    ]
+
+    # a build installing other package versions is not discarded
+    manifest_file = (
+        app.config["CACHE_PATH"]
+        / "SNAPSHOT/testtarget/testsubtarget"
+        / "openwrt-testtarget-testsubtarget-testprofile.manifest"
+    )
+    manifest_file.write_text(
+        manifest_file.read_text().replace("busybox - 1.31.1-1", "busybox - 1.32.0-1")
+    )
+    updated = build(dict(request_data))
+    assert updated["bin_dir"] != result["bin_dir"]
+    assert (
+        load_result(app.config["STORE_PATH"], updated)["manifest"]["busybox"]
+        == "1.32.0-1"
+    )
+
+
+def test_build_fake_reuse_install(app, upstream, httpserver):
+    request_data = dict(
+        version_data={
+            "branch": "master",
+            "path": "snapshots",
+            "pubkey": "RWSrHfFmlHslUcLbXFIRp+eEikWF9z1N77IJiX5Bt/nJd1a/x+L+SU89",
+        },
+        target="testtarget/testsubtarget",
+        store_path=app.config["STORE_PATH"],
+        cache_path=app.config["CACHE_PATH"],
+        upstream_url="http://localhost:8001",
+        version="SNAPSHOT",
+        profile="testprofile",
+    )
+    build(request_data)
+    current = app.config["CACHE_PATH"] / "SNAPSHOT/testtarget/testsubtarget"
+    install = current.resolve()
+    assert current.is_symlink()
+    assert install.name == (
+        "cf0c7c8f5601fac5a6420f6ce9c2308f374d47b133af6334dc30304b50528a74"
+    )
+
+    # pretend upstream changed, but the archive checksum stays the same
+    (current.parent / "testsubtarget_stamp").write_text("")
+    build(request_data)
+    assert current.resolve() == install
+    archive_requests = [r for r, _ in httpserver.log if r.path.endswith(".tar.xz")]
+    assert len(archive_requests) == 1
+
+
+def test_remove_unused_installs(tmp_path):
+    installs = tmp_path / "testsubtarget_installs"
+    for name in ["old", "used", "new"]:
+        (installs / name).mkdir(parents=True)
+        (installs / name / ".lock").touch()
+
+    current = tmp_path / "testsubtarget"
+    activate_install(current, installs / "used")
+    with use_install(current) as ib_path:
+        assert ib_path == installs / "used"
+        activate_install(current, installs / "new")
+        remove_unused_installs(current)
+        assert ib_path.is_dir()
+        assert not (installs / "old").exists()
+
+    remove_unused_installs(current)
+    assert not (installs / "used").exists()
+    assert (installs / "new").is_dir()
+
+
+def test_use_install_missing(tmp_path):
+    current = tmp_path / "testsubtarget"
+    activate_install(current, tmp_path / "testsubtarget_installs" / "removed")
+
+    with pytest.raises(AssertionError, match="is missing"):
+        with use_install(current):
+            pass
+
+
+def test_use_slot(tmp_path):
+    install = tmp_path / "testsubtarget_installs" / "used"
+    (install / "build_dir").mkdir(parents=True)
+    (install / "build_dir" / "stamp").write_text("test")
+    (install / "packages").mkdir()
+    (install / "packages" / "Packages").write_text("test")
+    (install / "Makefile").write_text("test")
+    (install / ".lock").touch()
+
+    with use_slot(install) as slot_a, use_slot(install) as slot_b:
+        assert slot_a != slot_b
+        for slot in [slot_a, slot_b]:
+            assert (slot / "Makefile").samefile(install / "Makefile")
+            assert (slot / "build_dir" / "stamp").read_text() == "test"
+            assert not (slot / "build_dir" / "stamp").samefile(
+                install / "build_dir" / "stamp"
+            )
+            assert not (slot / "packages" / "Packages").samefile(
+                install / "packages" / "Packages"
+            )
+
+    with use_slot(install) as slot:
+        assert slot == slot_a
+
+    current = tmp_path / "testsubtarget"
+    activate_install(current, tmp_path / "testsubtarget_installs" / "new")
+    remove_unused_installs(current)
+    assert not slot_a.parent.exists()
+
+
+def test_stream_build(tmp_path, redis):
+    job = Queue(connection=redis).enqueue("asu.build.build")
+    log_file = tmp_path / "buildlog.txt.gz"
+    returncode, tail = stream_build(
+        [
+            "sh",
+            "-c",
+            "echo Installing packages...; echo error >&2; echo Building images...; exit 3",
+        ],
+        tmp_path,
+        log_file,
+        job,
+        tail_lines=2,
+    )
+    assert returncode == 3
+    assert tail == ["error\n", "Building images...\n"]
+    assert gzip.decompress(log_file.read_bytes()).decode().startswith("Installing")
+    job.refresh()
+    assert job.meta["phase"] == "image"
+
+
+def test_get_last_modified(redis, httpserver):
+    url = "/snapshots/targets/testtarget/testsubtarget/sha256sums.sig"
+    stamp = "Thu, 19 Mar 2020 20:27:41 GMT"
+    httpserver.expect_request(
+        url, method="HEAD", headers={"If-Modified-Since": stamp}
+    ).respond_with_data(status=304)
+    httpserver.expect_request(url, method="HEAD").respond_with_data(
+        headers={"Last-Modified": stamp}
+    )
+
+    for _ in range(3):
+        assert get_last_modified(httpserver.url_for(url), "test", redis, 60) == stamp
+    assert len(httpserver.log) == 1
+
+    redis.delete("test-fresh")
+    assert get_last_modified(httpserver.url_for(url), "test", redis, 60) == stamp
+    assert len(httpserver.log) == 2
+    assert httpserver.log[-1][1].status_code == 304
+
+
+@pytest.mark.parametrize("compression", ["xz", "gz"])
+def test_extract_stream(tmp_path, httpserver, compression):
+    (tmp_path / "ib").mkdir()
+    (tmp_path / "ib" / "Makefile").write_text("image:\n")
+    archive = tmp_path / f"ib.tar.{compression}"
+    with tarfile.open(archive, f"w:{compression}") as tar:
+        tar.add(tmp_path / "ib", arcname="openwrt-imagebuilder")
+
+    httpserver.expect_request("/ib.tar").respond_with_data(archive.read_bytes())
+    dest = tmp_path / "dest"
+    dest.mkdir()
+
+    archive_hash = extract_stream(httpserver.url_for("/ib.tar"), dest, 16)
+    assert archive_hash == hashlib.sha256(archive.read_bytes()).hexdigest()
+    assert (dest / "Makefile").read_text() == "image:\n"
+
+
+def test_extract_stream_failed_download(tmp_path, monkeypatch):
+    archive = tmp_path / "ib.tar.gz"
+    with tarfile.open(archive, "w:gz") as tar:
+        tar.add(tmp_path, arcname="openwrt-imagebuilder")
+
+    class Response(io.BytesIO):
+        def read(self, size=-1):
+            if self.tell():
+                raise ConnectionResetError()
+            return super().read(size)
+
+    monkeypatch.setattr(
+        "urllib.request.urlopen", lambda url, timeout: Response(archive.read_bytes())
+    )
+
+    with pytest.raises(ConnectionResetError):
+        extract_stream("http://localhost/ib.tar.gz", tmp_path, 16)
+
+
+def test_parse_info():
+    info = parse_info(
+        Path(
+            "./tests/upstream/snapshots/targets/testtarget/testsubtarget/"
+            "openwrt-imagebuilder-testtarget-testsubtarget.Linux-x86_64/"
+            "openwrt-testtarget-testsubtarget-testprofile.info"
+        ).read_text()
+    )
+    assert "kmod-ipt-offload" in info["default_packages"]
+    assert set(info["profiles"].keys()) == {"Default", "8dev_carambola2", "testprofile"}
+    assert info["profiles"]["testprofile"] == {
+        "title": "Testprofile",
+        "packages": [
+            "kmod-usb2",
+            "kmod-usb-chipidea2",
+            "kmod-usb-storage",
+            "-swconfig",
+        ],
+        "supported_devices": ["testvendor,testprofile", "testprofile"],
+    }
+
+
+def test_get_info(tmp_path):
+    (tmp_path / "Makefile").write_text(
+        "info:\n\t@echo 'Default Packages: base-files'\n"
+    )
+    assert get_info(tmp_path)["default_packages"] == ["base-files"]
+
+    # parsed output is reused
+    (tmp_path / "Makefile").write_text("info:\n\tfalse\n")
+    assert get_info(tmp_path)["default_packages"] == ["base-files"]
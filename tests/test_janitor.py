@@ -1,9 +1,359 @@
 from asu.build import build
 from pathlib import Path
+import gzip
+import hashlib
 import redis
 
 import pytest
 
 from pytest_httpserver import HTTPServer
+from werkzeug.wrappers import Response
 
 from asu.janitor import *
+
+
+def test_cleanup(app, runner, redis):
+    build_path = app.config["API_PATH"] / "build"
+    build_path.mkdir(parents=True)
+    for request_hash in ["expired", "valid"]:
+        (build_path / request_hash).write_text("{}")
+        (build_path / f"{request_hash}.gz").write_text("{}")
+
+    redis.zadd("static-results", {str(build_path / "expired"): 1})
+    redis.zadd("static-results", {str(build_path / "valid"): "+inf"})
+
+    result = runner.invoke(args=["janitor", "cleanup"])
+    assert result.exit_code == 0
+    assert not (build_path / "expired").exists()
+    assert not (build_path / "expired.gz").exists()
+    assert (build_path / "valid").exists()
+    assert redis.zcard("static-results") == 1
+
+
+def test_prefetch(app, runner, redis, httpserver: HTTPServer):
+    content = b"busybox"
+    sha256sum = hashlib.sha256(content).hexdigest()
+    manifest_path = (
+        app.config["JSON_PATH"] / "snapshots/testtarget/testsubtarget/manifest.json"
+    )
+    manifest_path.parent.mkdir(parents=True)
+    luci_sha256sum = hashlib.sha256(b"luci").hexdigest()
+    manifest_path.write_text(
+        json.dumps(
+            {
+                "busybox": {
+                    "architecture": "mips_mips32",
+                    "filename": "busybox.ipk",
+                    "repository": "base",
+                    "sha256sum": sha256sum,
+                },
+                "luci": {
+                    "architecture": "all",
+                    "filename": "luci.ipk",
+                    "repository": "luci",
+                    "sha256sum": luci_sha256sum,
+                },
+            }
+        )
+    )
+    httpserver.expect_request(
+        "/snapshots/packages/mips_mips32/base/busybox.ipk"
+    ).respond_with_data(content)
+    # architecture independent packages are stored below the target arch
+    httpserver.expect_request(
+        "/snapshots/packages/mips_mips32/luci/luci.ipk"
+    ).respond_with_data(b"luci")
+    redis.zincrby("package-requests", 1, "busybox")
+    redis.zincrby("package-requests", 1, "luci")
+    redis.hset("arch-snapshot", "testtarget/testsubtarget", "mips_mips32")
+
+    result = runner.invoke(args=["janitor", "prefetch"])
+    assert result.exit_code == 0
+    store = app.config["CACHE_PATH"] / "packages"
+    assert get_cache_file(store, sha256sum).read_bytes() == content
+    assert get_cache_file(store, luci_sha256sum).read_bytes() == b"luci"
+
+
+@pytest.fixture
+def janitor_upstream(app, httpserver: HTTPServer):
+    upstream_path = Path("./tests/upstream/snapshots/targets/testtarget/testsubtarget")
+    targets = ["testtarget/testsubtarget", "testtarget/other"]
+    app.config["JSON_URL"] = "http://localhost:8001/json"
+    # repositories not served are missing upstream
+    httpserver.no_handler_status_code = 404
+
+    # base repository supporting conditional requests and failing targets
+    base = {
+        "content": "Package: luci\nVersion: 1\n\n",
+        "status": 200,
+        "failing_targets": set(),
+    }
+
+    def target_handler(target):
+        def handler(request):
+            if target in base["failing_targets"]:
+                return Response(status=503)
+            return Response((upstream_path / "packages/Packages").read_bytes())
+
+        return handler
+
+    httpserver.expect_request("/snapshots/targets/").respond_with_json(targets)
+    for target in targets:
+        httpserver.expect_request(
+            f"/snapshots/targets/{target}/packages/Packages.manifest"
+        ).respond_with_handler(target_handler(target))
+        profiles = json.loads(
+            (
+                upstream_path
+                / "openwrt-imagebuilder-testtarget-testsubtarget.Linux-x86_64"
+                / "profiles.json"
+            ).read_text()
+        )
+        profiles["profiles"] = {
+            f"{target.split('/')[1]}-profile": profiles["profiles"]["testprofile"]
+        }
+        httpserver.expect_request(
+            f"/json/snapshots/{target}/profiles.json"
+        ).respond_with_json(profiles)
+
+    def base_handler(request):
+        if base["status"] != 200:
+            return Response(status=base["status"])
+        etag = f'"{hashlib.sha256(base["content"].encode()).hexdigest()}"'
+        if request.headers.get("If-None-Match") == etag:
+            return Response(status=304)
+        return Response(base["content"], headers={"ETag": etag})
+
+    httpserver.expect_request(
+        "/snapshots/packages/mips_mips32/base/Packages.manifest"
+    ).respond_with_handler(base_handler)
+
+    return targets, base
+
+
+def test_update(app, runner, redis, httpserver: HTTPServer, janitor_upstream):
+    targets, _ = janitor_upstream
+    redis.sadd("targets-snapshot", "removed/target")
+    redis.sadd("packages-snapshot-removed/target", "test1")
+
+    result = runner.invoke(args=["janitor", "update"])
+    assert result.exit_code == 0
+
+    # repositories of the same architecture are fetched once
+    base_requests = [
+        r
+        for r, _ in httpserver.log
+        if r.path.endswith("/mips_mips32/base/Packages.manifest")
+    ]
+    assert len(base_requests) == 1
+
+    for target in targets:
+        manifest = json.loads(
+            (
+                app.config["JSON_PATH"] / "snapshots" / target / "manifest.json"
+            ).read_text()
+        )
+        assert manifest["block-mount"]["repository"] == target
+        assert redis.sismember(f"packages-snapshot-{target}", "block-mount")
+        assert manifest["luci"]["repository"] == "base"
+
+    profiles = json.loads(
+        (app.config["JSON_PATH"] / "snapshots/profiles.json").read_text()
+    )
+    assert sorted(profiles["profiles"]) == ["other-profile", "testsubtarget-profile"]
+    assert profiles["profiles"]["other-profile"]["target"] == "testtarget/other"
+    assert redis.get("generation-snapshot") == b"1"
+
+    # previous data is replaced, staged keys are renamed
+    assert redis.smembers("targets-snapshot") == {t.encode() for t in targets}
+    assert not redis.exists("packages-snapshot-removed/target")
+    assert not redis.sismember("packages-snapshot-testtarget/testsubtarget", "test1")
+    assert redis.hgetall("profiles-snapshot") == {
+        b"other-profile": b"testtarget/other",
+        b"testsubtarget-profile": b"testtarget/testsubtarget",
+    }
+    assert b"testvendor,testprofile" not in redis.hgetall("mapping-snapshot")
+    assert not redis.keys("*@*")
+    assert redis.ttl("targets-snapshot") == -1
+
+
+def test_update_incremental(
+    app, runner, redis, httpserver: HTTPServer, janitor_upstream
+):
+    targets, base = janitor_upstream
+    manifest_path = app.config["JSON_PATH"] / "snapshots" / targets[0] / "manifest.json"
+    profiles_path = app.config["JSON_PATH"] / "snapshots/profiles.json"
+
+    assert runner.invoke(args=["janitor", "update"]).exit_code == 0
+    profiles = profiles_path.read_text()
+    manifest_path.write_text("{}")
+
+    # nothing changed upstream, nothing is written
+    assert runner.invoke(args=["janitor", "update"]).exit_code == 0
+    assert manifest_path.read_text() == "{}"
+    assert profiles_path.read_text() == profiles
+    assert redis.get("generation-snapshot") == b"1"
+    assert [
+        response.status_code
+        for request, response in httpserver.log
+        if request.path.endswith("/mips_mips32/base/Packages.manifest")
+    ] == [200, 304]
+
+    # a changed repository updates all targets using it
+    base["content"] = "Package: luci\nVersion: 2\n\n"
+    assert runner.invoke(args=["janitor", "update"]).exit_code == 0
+    manifest = json.loads(manifest_path.read_text())
+    assert manifest["luci"]["version"] == "2"
+    assert manifest["block-mount"]["repository"] == targets[0]
+    assert json.loads(profiles_path.read_text()) == json.loads(profiles)
+    assert redis.get("generation-snapshot") == b"2"
+    assert redis.hlen("profiles-snapshot") == 2
+    assert redis.sismember(f"packages-snapshot-{targets[1]}", "luci")
+
+
+def test_update_failed_upstream(
+    app, runner, redis, httpserver: HTTPServer, janitor_upstream
+):
+    targets, base = janitor_upstream
+    assert runner.invoke(args=["janitor", "update"]).exit_code == 0
+
+    # a failed repository keeps the previous packages of all targets using it
+    base["content"] = "Package: luci\nVersion: 2\n\n"
+    base["status"] = 503
+    redis.sadd("targets-snapshot", "removed/target")
+    assert runner.invoke(args=["janitor", "update"]).exit_code == 0
+    for target in targets:
+        assert redis.sismember(f"packages-snapshot-{target}", "luci")
+    assert redis.hlen("profiles-snapshot") == 2
+
+    # the next successful run updates the packages
+    base["status"] = 200
+    assert runner.invoke(args=["janitor", "update"]).exit_code == 0
+    manifest = json.loads(
+        (
+            app.config["JSON_PATH"] / "snapshots" / targets[0] / "manifest.json"
+        ).read_text()
+    )
+    assert manifest["luci"]["version"] == "2"
+
+
+def test_update_failed_target(
+    app, runner, redis, httpserver: HTTPServer, janitor_upstream
+):
+    targets, base = janitor_upstream
+    assert runner.invoke(args=["janitor", "update"]).exit_code == 0
+
+    # the shared repository changes while the index of one target fails
+    base["content"] = "Package: luci\nVersion: 2\n\n"
+    base["failing_targets"] = {targets[1]}
+    assert runner.invoke(args=["janitor", "update"]).exit_code == 0
+
+    def get_luci_version(target):
+        manifest_path = app.config["JSON_PATH"] / "snapshots" / target / "manifest.json"
+        return json.loads(manifest_path.read_text())["luci"]["version"]
+
+    assert get_luci_version(targets[0]) == "2"
+    assert get_luci_version(targets[1]) == "1"
+
+    # the failed target is updated by the next run
+    base["failing_targets"] = set()
+    assert runner.invoke(args=["janitor", "update"]).exit_code == 0
+    assert get_luci_version(targets[1]) == "2"
+
+
+def test_update_locked(app, runner, redis, janitor_upstream):
+    redis.set("janitor-lock-snapshot", "other")
+    assert runner.invoke(args=["janitor", "update"]).exit_code == 0
+    assert not redis.exists("generation-snapshot")
+
+    redis.delete("janitor-lock-snapshot")
+    assert runner.invoke(args=["janitor", "update"]).exit_code == 0
+    assert redis.get("generation-snapshot") == b"1"
+    assert not redis.exists("janitor-lock-snapshot")
+
+
+def test_store_version_concurrent(app, redis, monkeypatch):
+    pipeline = redis.pipeline
+
+    def concurrent_pipeline(transaction=True):
+        if not transaction:
+            # another janitor stores a generation while data is staged
+            redis.incr("generation-snapshot")
+        return pipeline(transaction)
+
+    monkeypatch.setattr(redis, "pipeline", concurrent_pipeline)
+    with app.app_context():
+        store_version(
+            {"name": "snapshot"},
+            {"targets-snapshot": ["new/target"]},
+            [],
+            {"http://localhost/Packages": {"hash": "new"}},
+        )
+
+    assert redis.get("generation-snapshot") == b"1"
+    assert redis.smembers("targets-snapshot") == {b"testtarget/testsubtarget"}
+    assert not redis.keys("*@*")
+    assert not redis.exists("index-http://localhost/Packages")
+
+
+def test_update_validators_stored_with_data(
+    app, runner, redis, janitor_upstream, monkeypatch
+):
+    targets, _ = janitor_upstream
+
+    def failing_store_version(*args):
+        raise RuntimeError("store failed")
+
+    monkeypatch.setattr("asu.janitor.store_version", failing_store_version)
+    assert runner.invoke(args=["janitor", "update"]).exit_code != 0
+    assert not redis.keys("index-*")
+
+    # the next run fetches all indexes again and stores them
+    monkeypatch.undo()
+    assert runner.invoke(args=["janitor", "update"]).exit_code == 0
+    assert redis.get("generation-snapshot") == b"1"
+    assert redis.sismember(f"packages-snapshot-{targets[0]}", "luci")
+    assert redis.keys("index-*")
+
+
+def test_parse_packages():
+    import email.parser
+
+    text = Path(
+        "./tests/upstream/snapshots/targets/testtarget/testsubtarget/packages/Packages"
+    ).read_text()
+
+    expected = {}
+    for stanza in (text + "\n").split("\n\n")[:-1]:
+        package = email.parser.Parser().parsestr(stanza + "\n")
+        expected[package["Package"]] = dict(
+            (name.lower().replace("-", "_"), val)
+            for name, val in package.items()
+            if name.lower().replace("-", "_") in PACKAGE_FIELDS
+        )
+        expected[package["Package"]]["repository"] = "base"
+
+    packages = parse_packages(text.splitlines(), "base")
+    assert list(packages) == ["base-files", "block-mount", "blockd"]
+    assert packages == expected
+    assert packages["blockd"]["sha256sum"].startswith("4186637e")
+    assert "license" not in packages["blockd"]
+
+
+def test_parse_packages_continuation():
+    packages = parse_packages(
+        ["Package: test", "Description: first", " second", "License: GPL", " x", ""],
+        "base",
+    )
+    assert packages["test"]["description"] == "first\n second"
+    assert "license" not in packages["test"]
+
+
+def test_parse_packages_file_gz(app, httpserver: HTTPServer):
+    content = b"Package: test\nVersion: 1\n\n"
+    httpserver.expect_request("/Packages.gz").respond_with_data(gzip.compress(content))
+    with app.app_context():
+        packages = parse_packages_file("http://localhost:8001/Packages.gz", "base")
+    assert packages == {
+        "test": {"package": "test", "version": "1", "repository": "base"}
+    }
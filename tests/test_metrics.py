@@ -0,0 +1,30 @@
+from asu.metrics import *
+
+
+def test_render_metrics(redis):
+    labels = {"target": "x86/64", "version": "SNAPSHOT"}
+    increment(redis, "asu_builds_total", dict(labels, status="finished"))
+    increment(redis, "asu_builds_total", dict(labels, status="finished"), 2)
+    observe(redis, "asu_build_phase_seconds", dict(labels, phase="image"), 42)
+
+    metrics = render_metrics(redis).splitlines()
+    assert "# TYPE asu_builds_total counter" in metrics
+    assert (
+        'asu_builds_total{status="finished",target="x86/64",version="SNAPSHOT"} 3'
+        in metrics
+    )
+    assert "# TYPE asu_build_phase_seconds histogram" in metrics
+    phase_labels = 'phase="image",target="x86/64",version="SNAPSHOT"'
+    assert f'asu_build_phase_seconds_bucket{{{phase_labels},le="30"}} 0' in metrics
+    assert f'asu_build_phase_seconds_bucket{{{phase_labels},le="60"}} 1' in metrics
+    assert f'asu_build_phase_seconds_bucket{{{phase_labels},le="+Inf"}} 1' in metrics
+    assert f"asu_build_phase_seconds_sum{{{phase_labels}}} 42" in metrics
+    assert f"asu_build_phase_seconds_count{{{phase_labels}}} 1" in metrics
+
+
+def test_metrics_endpoint(client, redis):
+    increment(redis, "asu_imagebuilder_refreshes_total", {"target": "x86/64"})
+    response = client.get("/metrics")
+    assert response.status == "200 OK"
+    assert response.mimetype == "text/plain"
+    assert b'asu_imagebuilder_refreshes_total{target="x86/64"} 1' in response.data
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from asu.package_cache import *
+
+
+def sha256(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def test_store_and_link_packages(tmp_path):
+    store = tmp_path / "packages"
+    dl_dir = tmp_path / "dl"
+    dl_dir.mkdir()
+    (dl_dir / "busybox.ipk").write_bytes(b"busybox")
+    (dl_dir / "broken.ipk").write_bytes(b"broken")
+    checksums = {
+        "busybox.ipk": sha256(b"busybox"),
+        "broken.ipk": sha256(b"something else"),
+    }
+
+    assert store_packages(store, dl_dir, checksums) == 1
+    assert list(dl_dir.iterdir()) == []
+    assert get_cache_file(store, sha256(b"busybox")).read_bytes() == b"busybox"
+
+    assert link_packages(store, dl_dir, checksums) == {"busybox.ipk"}
+    assert (dl_dir / "busybox.ipk").read_bytes() == b"busybox"
+
+
+def test_evict_packages(tmp_path):
+    store = tmp_path / "packages"
+    for age, content in enumerate([b"new", b"old"]):
+        path = tmp_path / f"{age}.ipk"
+        path.write_bytes(content)
+        add_file(store, path, sha256(content))
+        os.utime(get_cache_file(store, sha256(content)), (0, 1000 - age))
+
+    evict_packages(store, 3)
+    assert get_cache_file(store, sha256(b"new")).is_file()
+    assert not get_cache_file(store, sha256(b"old")).exists()
+
+
+def test_evict_packages_concurrent(tmp_path, monkeypatch):
+    store = tmp_path / "packages"
+    path = tmp_path / "old.ipk"
+    path.write_bytes(b"old")
+    add_file(store, path, sha256(b"old"))
+
+    unlink = Path.unlink
+
+    def concurrent_unlink(self):
+        # evicted by another worker first
+        unlink(self)
+        unlink(self)
+
+    monkeypatch.setattr(Path, "unlink", concurrent_unlink)
+    evict_packages(store, 0)
+    assert not get_cache_file(store, sha256(b"old")).exists()
+
+
+def test_use_package_cache(tmp_path):
+    store = tmp_path / "packages"
+    manifest_path = tmp_path / "manifest.json"
+    manifest_path.write_text(
+        json.dumps(
+            {"busybox": {"filename": "busybox.ipk", "sha256sum": sha256(b"busybox")}}
+        )
+    )
+
+    for _ in range(2):
+        dl_dir = tmp_path / "dl"
+        with use_package_cache(store, dl_dir, manifest_path, 1024):
+            if not (dl_dir / "busybox.ipk").exists():
+                (dl_dir / "busybox.ipk").write_bytes(b"busybox")
+                downloaded = True
+            else:
+                downloaded = False
+
+    assert not downloaded
+    assert not (dl_dir / "busybox.ipk").exists()
+
+
+def test_use_package_cache_installed(tmp_path):
+    store = tmp_path / "packages"
+    dl_dir = tmp_path / "dl"
+    index = {}
+    for name in ["busybox", "vim", "nano"]:
+        path = tmp_path / f"{name}.ipk"
+        path.write_bytes(name.encode())
+        add_file(store, path, sha256(name.encode()))
+        os.utime(get_cache_file(store, sha256(name.encode())), (0, 1000))
+        index[name] = {"filename": f"{name}.ipk", "sha256sum": sha256(name.encode())}
+    manifest_path = tmp_path / "manifest.json"
+    manifest_path.write_text(json.dumps(index))
+
+    # only requested packages are linked
+    with use_package_cache(
+        store, dl_dir, manifest_path, 1024, ["busybox", "vim"]
+    ) as stats:
+        assert sorted(p.name for p in dl_dir.iterdir()) == ["busybox.ipk", "vim.ipk"]
+        stats["installed"] = {"busybox"}
+
+    # only installed packages are hits and marked as recently used
+    assert stats["hits"] == 1
+    assert get_cache_file(store, sha256(b"busybox")).stat().st_mtime > 1000
+    assert get_cache_file(store, sha256(b"vim")).stat().st_mtime == 1000
+    assert get_cache_file(store, sha256(b"nano")).stat().st_mtime == 1000
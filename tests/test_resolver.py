@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+from asu.resolver import *
+
+
+@pytest.fixture
+def index(tmp_path):
+    manifest = {
+        "base-files": {"version": "1", "depends": "libc, netifd"},
+        "busybox": {"version": "1.31.1-1", "depends": "libc"},
+        "libc": {"version": "1.1.24-2"},
+        "netifd": {"version": "2", "depends": "libc, libubox20191228 (>= 2020)"},
+        "libubox20191228": {"version": "3", "depends": "libc"},
+        "wpad-basic": {"version": "4", "depends": "libc", "provides": "hostapd"},
+        "wpad-mini": {"version": "5", "depends": "libc", "provides": "hostapd"},
+        "hostapd-utils": {"version": "6", "depends": "hostapd"},
+        "dnsmasq": {"version": "7", "depends": "libc"},
+        "dnsmasq-full": {"version": "8", "depends": "libc"},
+        "odhcpd": {"version": "9", "depends": "dnsmasq | dnsmasq-full"},
+    }
+    manifest_path = tmp_path / "manifest.json"
+    manifest_path.write_text(json.dumps(manifest))
+    return manifest_path
+
+
+def test_parse_depends():
+    assert parse_depends("libc, libubox (>= 2020), busybox | busybox-selinux") == [
+        ["libc"],
+        ["libubox"],
+        ["busybox", "busybox-selinux"],
+    ]
+    assert parse_depends("") == []
+
+
+def test_resolve_manifest(index):
+    assert resolve_manifest(index, ["base-files", "busybox"]) == {
+        "base-files": "1",
+        "busybox": "1.31.1-1",
+        "libc": "1.1.24-2",
+        "libubox20191228": "3",
+        "netifd": "2",
+    }
+
+
+def test_resolve_manifest_remove(index):
+    assert resolve_manifest(index, ["busybox", "base-files", "-base-files"]) == {
+        "busybox": "1.31.1-1",
+        "libc": "1.1.24-2",
+    }
+
+
+def test_resolve_manifest_provides(index):
+    assert "wpad-basic" in resolve_manifest(index, ["hostapd-utils"])
+    assert "wpad-basic" not in resolve_manifest(index, ["wpad-mini", "hostapd-utils"])
+
+
+def test_resolve_manifest_alternatives(index):
+    assert "dnsmasq" in resolve_manifest(index, ["odhcpd"])
+    assert "dnsmasq" not in resolve_manifest(index, ["odhcpd", "dnsmasq-full"])
+
+
+def test_resolve_manifest_unknown(index):
+    with pytest.raises(AssertionError, match="Unknown package test1"):
+        resolve_manifest(index, ["busybox", "test1"])
@@ -0,0 +1,108 @@
+from datetime import timedelta
+import gzip
+import json
+import time
+
+from rq import Queue
+
+from asu.metrics import render_metrics
+from asu.worker import (
+    Worker,
+    get_warm_key,
+    publish_result,
+    record_duration,
+    record_metrics,
+)
+
+
+def test_get_affinity_queues(redis):
+    for target in ["ath79/generic", "x86/64", "ramips/mt7621"]:
+        Queue(target, connection=redis).enqueue("os.getcwd")
+
+    redis.sadd(get_warm_key(), "x86/64", "mvebu/cortexa9")
+
+    worker = Worker(["default"], connection=redis)
+    assert worker.queue_names() == ["default"]
+    assert list(map(lambda q: q.name, worker.get_affinity_queues())) == [
+        "x86/64",
+        "default",
+        "ath79/generic",
+        "ramips/mt7621",
+    ]
+
+
+def test_dequeue_job_and_maintain_ttl(redis):
+    Queue("ath79/generic", connection=redis).enqueue("os.getcwd", job_id="cold")
+    Queue("x86/64", connection=redis).enqueue("os.getcwd", job_id="warm")
+    redis.sadd(get_warm_key(), "x86/64")
+
+    worker = Worker(["default"], connection=redis)
+    job, queue = worker.dequeue_job_and_maintain_ttl(None)
+    assert job.id == "warm"
+    job, queue = worker.dequeue_job_and_maintain_ttl(None)
+    assert job.id == "cold"
+    assert worker.dequeue_job_and_maintain_ttl(None) is None
+
+
+def test_publish_result(app, redis):
+    job = Queue(connection=redis).enqueue(
+        "os.getcwd",
+        {
+            "api_path": str(app.config["API_PATH"]),
+            "store_path": app.config["STORE_PATH"],
+        },
+        result_ttl=60,
+    )
+    job._result = {"id": "testprofile"}
+    job.ended_at = job.enqueued_at
+    job.set_status("finished")
+
+    publish_result(job)
+
+    static_file = app.config["API_PATH"] / "build" / job.id
+    response = json.loads(static_file.read_text())
+    assert response["id"] == "testprofile"
+    assert response["request_hash"] == job.id
+    assert (
+        json.loads(gzip.decompress((static_file.parent / f"{job.id}.gz").read_bytes()))
+        == response
+    )
+    assert redis.zscore("static-results", str(static_file)) > time.time()
+
+
+def test_publish_result_not_finished(app, redis):
+    job = Queue(connection=redis).enqueue(
+        "os.getcwd", {"api_path": str(app.config["API_PATH"])}
+    )
+    publish_result(job)
+    assert not (app.config["API_PATH"] / "build" / job.id).exists()
+
+
+def test_record_duration(redis):
+    job = Queue(connection=redis).enqueue("os.getcwd")
+    job.started_at = job.enqueued_at
+    job.ended_at = job.enqueued_at + timedelta(seconds=42)
+
+    for _ in range(3):
+        record_duration(job, samples=2)
+
+    assert redis.lrange("build-durations", 0, -1) == [b"42.0", b"42.0"]
+
+
+def test_record_metrics(redis):
+    job = Queue(connection=redis).enqueue(
+        "asu.build.build", {"target": "x86/64", "version": "SNAPSHOT"}
+    )
+    job.meta["timings"] = {"image": 3.5}
+    job.set_status("failed")
+    record_metrics(job)
+
+    metrics = render_metrics(redis)
+    assert (
+        'asu_builds_total{status="failed",target="x86/64",version="SNAPSHOT"} 1'
+        in metrics
+    )
+    assert (
+        'asu_build_phase_seconds_count{phase="image",target="x86/64",version="SNAPSHOT"} 1'
+        in metrics
+    )